@@ -3,17 +3,52 @@ import asyncio
 
 import server
 import bot
+import sharding
+import bridge
+import ipc
+
+
+def make_client(ref, shards):
+    if shards is None:
+        return bot.MyClient(ref)
+    return bot.ShardedClient(ref, **shards)
 
 
 async def main():
-    queue = asyncio.Queue()
-    port = os.environ.get('SERVER_PORT', 63083)
+    queue = bridge.make_queue()
+    port = sharding.server_port()
+    shards = sharding.shard_options()
     if os.environ.get('SERVER_ONLY'):
+        # Lobbies fed by the BOT_ONLY process through IPC_PATH
+        subscriber = ipc.Subscriber(queue)
+        server.stats_providers["ipc"] = subscriber.stats
+        await asyncio.gather(
+            server.main(queue, port=port),
+            subscriber.run()
+        )
+    elif os.environ.get('BOT_ONLY'):
+        # Messages published on IPC_PATH for the SERVER_ONLY processes
+        publisher = ipc.Publisher()
+        client = make_client(publisher, shards)
+        # Servers too far behind get the players in lobbies instead
+        publisher.snapshot = client.players.joined_messages
         await asyncio.gather(
-            server.main(queue, port=port)
+            publisher.serve(),
+            client.start(os.environ['DISCORD_BOT_TOKEN'])
+        )
+    elif shards is not None:
+        # One backend queue per shard, see sharding.shard_options for the settings
+        router = sharding.ShardRouter(lambda: client.shard_count, server.read_queue)
+        client = make_client(router, shards)
+        server.stats_providers["bot"] = client.stats
+        server.stats_providers["shards"] = router.stats
+        await asyncio.gather(
+            server.main(None, port=port),
+            client.start(os.environ['DISCORD_BOT_TOKEN'])
         )
     else:
         client = bot.MyClient(queue)
+        server.stats_providers["bot"] = client.stats
         await asyncio.gather(
             server.main(queue, port=port),
             client.start(os.environ['DISCORD_BOT_TOKEN'])
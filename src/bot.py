@@ -3,14 +3,12 @@ Contains the main functionnality of the bot
 and what will be imported to run it
 """
 
+import os
 import sys
 import logging
 from typing import Dict, List, Set, Union, Tuple, Callable, Awaitable, Optional
 from collections import OrderedDict
 
-import urllib.request
-import json
-
 import asyncio
 
 import discord
@@ -19,8 +17,15 @@ from guildconf import GuildConfig, LobbyVC
 from btag import Btag
 
 from messages import PlayerJoined, PlayerLeft
-import helper
+import owapi
 import pug_vc
+from cache import TTLCache, SingleFlight
+from member_executor import MemberExecutor
+from outbox import DiscordOutbox
+from careerstats import careerDatabase
+from config_store import GuildConfigStore
+from registration_store import RegistrationStore
+import sharding
 
 # TODO:
 # 3- test
@@ -31,17 +36,6 @@ import pug_vc
 # 8- Actual DB
 
 
-def _invert_lobby_lookup(config: Dict[int, GuildConfig]) -> Dict[int, Dict[int, int]]:
-    res = {}
-    for (gid, cfg) in config.items():
-        tmp = {}
-        for lobby in cfg.lobbies.values():
-            tmp[lobby.team1] = lobby.lobby
-            tmp[lobby.team2] = lobby.lobby
-        res[gid] = tmp
-    return res
-
-
 def _parse_command(message: discord.Message, content: str) -> Tuple[str, List[str]]:
     args = content.split()
     return (args[0], args[1:])
@@ -57,12 +51,12 @@ def _make_btag(btag: str) -> Optional[Btag]:
 class MyClient(discord.Client):
     """Set up and log bot in discord"""
 
-    def __init__(self, ref: asyncio.Queue):
+    def __init__(self, ref: Union[asyncio.Queue, sharding.ShardRouter], **options):
         from cmd_config import CmdConfigBot, CmdConfigPrint
         from commands import Command
-        from voice_channel_manager import VoiceChannelManager
+        from voice_channel_manager import VoiceChannelManager, VoiceStateCoalescer
         from pug_player_db import PUGPlayerDB
-        super().__init__()
+        super().__init__(**options)
         self._vc_mgr = VoiceChannelManager(self)
         self.logger = logging.getLogger("Bot")
         self.logger.setLevel(logging.DEBUG)
@@ -71,7 +65,9 @@ class MyClient(discord.Client):
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
         self.ref = ref
-        self.config = helper.load_config()
+        self.config = GuildConfigStore()
+        self.vc_index = pug_vc.ChannelIndex(self.config.guilds)
+        self.config.subscribe(self.vc_index.update_guild)
         self.commands: Dict[str, Command] = {
             CmdConfigBot.name(): CmdConfigBot(self),
             CmdConfigPrint.name(): CmdConfigPrint(self)
@@ -82,21 +78,46 @@ class MyClient(discord.Client):
                                                       discord.User]],
                                                Awaitable[bool]]] = {}
 
-        self.players = PUGPlayerDB(self)
+        # DMs only reach the process running shard 0, which writes the
+        # registrations for all of them
+        self.players = PUGPlayerDB(
+            self, RegistrationStore(writer=sharding.receives_dms()))
+        self._follow_task: Optional[asyncio.Future] = None
+        # Players may be in lobbies of shards run by other processes
+        self._other_shards = sharding.process_key() is not None
+        # Every message, edit and reaction sent goes through the outbox
+        self.outbox = DiscordOutbox()
+        # Events of a member are handled in order, members concurrently
+        self._events = MemberExecutor()
+        self._voice_moves = VoiceStateCoalescer(
+            float(os.environ.get('VOICE_COALESCE_WINDOW', 1.0)),
+            self._submit_voice_move)
+
+        # Known btags are cached for a long time, unknown ones (typos) briefly
+        self._btag_valid_ttl = float(os.environ.get('BTAG_VALID_TTL', 86400))
+        self._btag_unknown_ttl = float(os.environ.get('BTAG_UNKNOWN_TTL', 60))
+        self._btag_checks = TTLCache(int(os.environ.get('BTAG_CACHE_SIZE', 4096)),
+                                     self._btag_valid_ttl)
+        self._btag_inflight = SingleFlight()
+
+        # Periodic sweep repairing drift between voice states and players
+        self._reconcile_interval = float(os.environ.get('RECONCILE_INTERVAL', 600))
+        self._reconcile_task: Optional[asyncio.Future] = None
 
     @property
-    def all_vc(self):
-        """Return a list of all PUG related voice channels"""
-        return {
-            guild: [lobby for lobbyVC in cfg.lobbies.values()
-                    for lobby in [lobbyVC.lobby, lobbyVC.team1, lobbyVC.team2]]
-            for (guild, cfg) in self.config.items()
-        }
+    def all_vc(self) -> Dict[int, Set[int]]:
+        """Return the set of PUG related voice channels of each guild"""
+        return self.vc_index.by_guild
 
-    @property
-    def invert_lobby_lookup(self):
-        """Return a mapping of lobby corresponding to a team VC"""
-        return _invert_lobby_lookup(self.config)
+    def stats(self):
+        """Metrics of the bot's internal queues"""
+        return {"events": self._events.stats(),
+                "voiceStates": self._voice_moves.stats(),
+                "outbox": self.outbox.stats()}
+
+    def add_guild_config(self, cfg: GuildConfig):
+        """Add or replace the config of a guild, its channels are reindexed"""
+        self.config.put(cfg)
 
     async def on_ready(self):
         """Execute when client is ready"""
@@ -104,17 +125,75 @@ class MyClient(discord.Client):
         for guild in self.guilds:
             if guild.id not in self.config:
                 self.logger.debug('Guild %s has no config, generating default', guild.name)
-                self.logger.debug('config keys: %s', ", ".join(self.config.keys()))
+                self.logger.debug('config keys: %s', ", ".join(map(str, self.config.guilds)))
                 self.logger.debug('guild id: %s', guild.id)
-                self.config[guild.id] = GuildConfig(guild.id, {}, "%")
-        helper.save_config(self.config)
-
+                self.add_guild_config(GuildConfig(guild.id, {}, "%"))
+        await self.reconcile_voice_states()
+        if self._follow_task is None and not self.players.registrations.writer:
+            self._follow_task = asyncio.ensure_future(self.players.registrations.follow())
+        if self._reconcile_task is None and self._reconcile_interval > 0:
+            self._reconcile_task = asyncio.ensure_future(self._reconcile_periodically())
+
+    def _pug_voice_members(self) -> Dict[int, Tuple[discord.Member, discord.VoiceChannel]]:
+        """Members currently in a PUG voice channel, with their lobby VC"""
+        present = {}
+        for gid, channels in self.vc_index.by_guild.items():
+            guild = self.get_guild(gid)
+            if guild is None:
+                continue
+            for cid in channels:
+                lobby_id = self.vc_index.lobby_channel(cid)
+                if lobby_id is None:
+                    continue
+                chan = guild.get_channel(cid)
+                lobby = guild.get_channel(lobby_id)
+                if not isinstance(chan, discord.VoiceChannel):
+                    continue
+                if not isinstance(lobby, discord.VoiceChannel):
+                    continue
+                for mem in chan.members:
+                    if not mem.bot:
+                        present[mem.id] = (mem, lobby)
+        return present
+
+    async def reconcile_voice_states(self):
+        """
+        Rebuild the player list from the members sitting in PUG lobbies,
+        e.g. after a restart or when some voice events were missed,
+        and notify the backend in one go
+        """
+        present = self._pug_voice_members()
+        # Members with events in flight are already being taken care of
+        busy = {did for did in set(present) | {did for did, _ in self.players.items()}
+                if self._events.is_busy(did) or self._voice_moves.is_pending(did)}
+        present = {did: v for did, v in present.items() if did not in busy}
+        messages = await self.players.reconcile(present, skip=busy)
+        for msg in messages:
+            await self.ref.put(msg)
+        self.logger.info("Reconciled %d members in PUG lobbies, %d updates sent",
+                         len(present), len(messages))
+
+    async def _reconcile_periodically(self):
+        while True:
+            await asyncio.sleep(self._reconcile_interval)
+            try:
+                await self.reconcile_voice_states()
+            except Exception:
+                self.logger.exception("Voice state reconciliation failed")
+
+
+    async def close(self):
+        """Flush what is still waiting to be saved before logging out"""
+        await self.players.registrations.close()
+        await self.config.close()
+        await super().close()
 
     async def on_dm(self, message):
         """
         When receiving a DM:
         - If the player isn't in `players` then do nothing (the player isn't in
-        any discord lobby)
+        any discord lobby), unless their lobby may be on a shard run by another
+        process: the btag is saved for it
         - Else:
            - Add the btag
            - If the player isn't registered the notify the backend
@@ -122,44 +201,57 @@ class MyClient(discord.Client):
         self.logger.debug('Got DM from %s', message.author.display_name)
         player = self.players.get(message.author.id)
         btag = _make_btag(message.content)
-        if not player:
+        if not player and not self._other_shards:
             self.logger.debug('%s is not in any lobby',
                               message.author.display_name)
-            await message.channel.send("You aren't in any lobby, join a lobby")
+            self.outbox.send(message.channel, "You aren't in any lobby, join a lobby")
         elif not btag:
-            await message.channel.send("Battle tag not understood, please resend it")
-        elif not await self._check_btag_exists(btag):
-            await message.channel.send("Could not get player data, are you sure you input battle tag correctly (with correct capitalisation)? (e.g. PlayerName#1235)")
-        elif not player.is_registered:
-            await self.players.add_btag(message.author.id, btag)
-            await self.players.register(message.author.id)
-            auth = message.author.display_name
-            tags = [e.to_string() for e
-                    in self.players.get(message.author.id).btags]
-            mess = "{} is registered with {}".format(auth, ", ".join(tags))
-            await message.channel.send(mess)
+            self.outbox.send(message.channel, "Battle tag not understood, please resend it")
         else:
-            await self.players.add_btag(message.author.id, btag)
-            self.logger.debug('Player %s already registered in the backend',
-                              message.author.display_name)
-            mess = "Your battletag has been updated to {}".format(btag.to_string())
-            await message.channel.send(mess)
+            exists = await self._check_btag_exists(btag)
+            if exists is None:
+                self.outbox.send(message.channel, "Could not reach the Overwatch profile service, please resend your battle tag in a few minutes")
+            elif not exists:
+                self.outbox.send(message.channel, "Could not get player data, are you sure you input battle tag correctly (with correct capitalisation)? (e.g. PlayerName#1235)")
+            elif not player:
+                # The process running the shard of their lobby, if any,
+                # picks it up from the registrations journal
+                self.players.remember_btag(message.author.id, btag)
+                mess = "Your battletag has been saved as {}".format(btag.to_string())
+                self.outbox.send(message.channel, mess)
+            elif not player.is_registered:
+                await self.players.add_btag(message.author.id, btag)
+                await self.players.register(message.author.id)
+                auth = message.author.display_name
+                tags = [e.to_string() for e
+                        in self.players.get(message.author.id).btags]
+                mess = "{} is registered with {}".format(auth, ", ".join(tags))
+                self.outbox.send(message.channel, mess)
+            else:
+                await self.players.add_btag(message.author.id, btag)
+                self.logger.debug('Player %s already registered in the backend',
+                                  message.author.display_name)
+                mess = "Your battletag has been updated to {}".format(btag.to_string())
+                self.outbox.send(message.channel, mess)
 
     async def _on_command(self, message: discord.Message):
         content = message.content[1:]
         command, args = _parse_command(message, content)
         if command == "help":
-            await message.channel.send("Command list: {}".format(
+            self.outbox.send(message.channel, "Command list: {}".format(
                 ", ".join(self.commands.keys())))
         elif command in self.commands:
             await self.commands[command].execute(message, args)
         else:
-            await message.channel.send("Command {} not found".format(command))
+            self.outbox.send(message.channel, "Command {} not found".format(command))
 
     async def on_message(self, message):
         """Execute when received message"""
         if message.author.bot:
             return
+        await self._events.submit(message.author.id, self._on_message, message)
+
+    async def _on_message(self, message):
         if isinstance(message.channel, discord.DMChannel):
             await self.on_dm(message)
         if isinstance(message.channel, discord.TextChannel):
@@ -174,21 +266,29 @@ class MyClient(discord.Client):
             return
         if reaction.message.id not in self.reaction_callbacks:
             return
+        # Reaction handlers keep their state per message, not per member
+        await self._events.submit(reaction.message.id,
+                                  self._on_reaction_add, reaction, user)
+
+    async def _on_reaction_add(self, reaction: discord.Reaction,
+                               user: Union[discord.Member, discord.User]):
+        if reaction.message.id not in self.reaction_callbacks:
+            return
         if await self.reaction_callbacks[reaction.message.id](reaction, user):
             del self.reaction_callbacks[reaction.message.id]
 
     def _come_from_team_vc(self, guild: int, before: int, after: int) -> bool:
         """Test if the player is moving from
         a team VC to the corresponding lobby VC"""
-        for lobby in self.config[guild].lobbies.values():
-            if lobby.lobby == after and before in (lobby.team1, lobby.team2):
-                return True
-        return False
+        entry = self.vc_index.get(before)
+        return (entry is not None and entry.guild_id == guild
+                and entry.role != pug_vc.ChannelIndex.LOBBY
+                and entry.lobby == after)
 
     async def send_registration_dm(self, mem: discord.Member):
         """Send a DM to a player to ask for their btag"""
-        dm_chan = await mem.create_dm()
-        await dm_chan.send("Give me your battle tag:")
+        self.outbox.send_dm(mem, "Give me your battle tag:",
+                            DiscordOutbox.PRIORITY_REGISTRATION)
 
     async def _handle_joining_lobby(self, mem: discord.Member,
                                     before: pug_vc.Other,
@@ -213,10 +313,10 @@ class MyClient(discord.Client):
 
     def _get_pugs_lobby(self, channel: discord.VoiceChannel):
         """Gets PUGs lobby of discord channel"""
-        for lobby in self.config[channel.guild.id].lobbies.values():
-            if channel.id in [lobby.lobby, lobby.team1, lobby.team2]:
-                return lobby
-        return None
+        entry = self.vc_index.get(channel.id)
+        if entry is None:
+            return None
+        return self.config[entry.guild_id].lobbies.get(entry.lobby_name)
 
     async def on_voice_state_update(self, mem: discord.Member,
                                     before: discord.VoiceState,
@@ -225,7 +325,6 @@ class MyClient(discord.Client):
         Callback for when someone change their VC state
         if someone join a lobby voice channel then call _handle_joining_lobby
         """
-
         # Type checking and making mypy happy
         if not isinstance(before.channel, (type(None), discord.VoiceChannel)):
             return
@@ -233,9 +332,23 @@ class MyClient(discord.Client):
             return
         assert isinstance(after.channel, (type(None), discord.VoiceChannel))
         assert isinstance(before.channel, (type(None), discord.VoiceChannel))
+        if before.channel == after.channel:
+            # Mute, deafen, stream...
+            return
+        # Bursts of moves are reduced to their net effect before being handled
+        await self._voice_moves.push(mem, before.channel, after.channel)
+
+    async def _submit_voice_move(self, mem: discord.Member,
+                                 before: Optional[discord.VoiceChannel],
+                                 after: Optional[discord.VoiceChannel]):
+        await self._events.submit(mem.id, self._on_voice_move,
+                                  mem, before, after)
 
-        before_wrap = pug_vc.make_vc_wrapper(self.config, before.channel)
-        after_wrap = pug_vc.make_vc_wrapper(self.config, after.channel)
+    async def _on_voice_move(self, mem: discord.Member,
+                             before: Optional[discord.VoiceChannel],
+                             after: Optional[discord.VoiceChannel]):
+        before_wrap = pug_vc.make_vc_wrapper(self.vc_index, before)
+        after_wrap = pug_vc.make_vc_wrapper(self.vc_index, after)
 
         if (isinstance(after_wrap, pug_vc.Other)
             and isinstance(before_wrap, pug_vc.Other)):
@@ -247,6 +360,12 @@ class MyClient(discord.Client):
             # Joining a lobby for the first time
             await self._vc_mgr.on_joining_lobby(mem, before_wrap, after_wrap)
 
+        elif (isinstance(after_wrap, pug_vc.Team)
+            and isinstance(before_wrap, pug_vc.Other)):
+            # Straight to a team VC, e.g. joined the lobby and was moved
+            # to a team within the coalescing window
+            await self._vc_mgr.on_joining_team_vc(mem, before_wrap, after_wrap)
+
         elif (isinstance(before_wrap, (pug_vc.Lobby, pug_vc.Team))
             and isinstance(after_wrap, pug_vc.Other)):
             # Leaving a pug voice channel
@@ -271,23 +390,51 @@ class MyClient(discord.Client):
 
     async def on_guild_join(self, guild):
         """Triggered when adding the bot to a guild"""
-        self.config[guild.id] = GuildConfig(guild.id, {}, "%")
+        self.add_guild_config(GuildConfig(guild.id, {}, "%"))
+
+    async def _check_btag_exists(self, btag: Btag) -> Optional[bool]:
+        """
+        Check the btag against ow-api, results are cached.
+        None if ow-api couldn't tell (down or throttling us)
+        """
+        known = self._btag_checks.get(btag.to_string())
+        if known is not None:
+            return known
+        return await self._btag_inflight.do(btag.to_string(),
+                                            self._query_btag, btag)
 
-    async def _check_btag_exists(self, btag: Btag):
+    async def _query_btag(self, btag: Btag) -> Optional[bool]:
         # https://playoverwatch.com/en-us/career/pc/{}/
-        #TODO: Proper header
-        _hdr = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like Gecko) Chrome/23.0.1271.64 Safari/537.11',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3',
-                'Accept-Encoding': 'none',
-                'Accept-Language': 'en-US,en;q=0.8',
-                'Connection': 'keep-alive' }
+        # The complete profile is fetched so that the backend
+        # doesn't need to query it again when the player joins
         try:
-            query = "https://ow-api.com/v1/stats/pc/EU/{}/profile".format(btag.for_api())
-            request = urllib.request.Request(query, None, _hdr)
-            response = urllib.request.urlopen(request)
-            response = response.read()
-        except urllib.error.HTTPError:
-            return False
-        data = json.loads(response.decode('utf-8'))
-        return 'name' in data.keys()
+            status, data = await owapi.client.fetch_status(
+                btag, "complete", owapi.OwApiClient.PRIORITY_VALIDATION)
+        except Exception:
+            self.logger.exception("Could not check btag %s", btag.to_string())
+            return None
+        if owapi.OwApiClient.is_transient(status, data):
+            # Not cached, the player is asked to try again later
+            return None
+        exists = data is not None and 'name' in data.keys()
+        if exists:
+            await careerDatabase.seed(btag, data)
+        self._btag_checks.put(btag.to_string(), exists,
+                              self._btag_valid_ttl if exists else self._btag_unknown_ttl)
+        return exists
+
+
+class ShardedClient(MyClient, discord.AutoShardedClient):
+    """
+    MyClient handling several gateway shards in this process,
+    all of them by default or the ones given by `shard_ids`
+    """
+
+    def stats(self):
+        stats = super().stats()
+        stats["shards"] = {shard: round(latency * 1000, 2)
+                           for shard, latency in self.latencies}
+        return stats
+
+    async def on_shard_ready(self, shard_id: int):
+        self.logger.info('Shard %d/%s ready', shard_id, self.shard_count)
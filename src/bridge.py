@@ -0,0 +1,75 @@
+"""
+Bridge applying the bot's messages to the server's lobbies
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+import helper
+from member_executor import MemberExecutor
+from messages import PlayerJoined, PlayerLeft
+
+
+Message = Union[PlayerJoined, PlayerLeft]
+
+
+def make_queue() -> asyncio.Queue:
+    """Queue between the bot and the server, putting waits once BRIDGE_QUEUE_SIZE are queued"""
+    return asyncio.Queue(maxsize=int(os.environ.get('BRIDGE_QUEUE_SIZE', 1000)))
+
+
+class LobbyBridge:
+    """
+    Read messages from the bot's queues in batches and apply them with
+    one worker per (server, lobby): a lobby gets its messages in order
+    while a slow one (e.g. waiting for a profile) doesn't hold up the
+    others. Once `max_backlog` messages are waiting for their lobby,
+    reading stops until one is applied, so the bot ends up waiting on
+    the queue.
+    """
+
+    def __init__(self, apply: Callable[[Message], Awaitable[None]],
+                 batch_size: Optional[int] = None,
+                 max_backlog: Optional[int] = None):
+        env = os.environ.get
+        self.batch_size = batch_size or int(env('BRIDGE_BATCH_SIZE', 100))
+        self.logger = helper.default_logger("LobbyBridge", logging.INFO)
+        self._apply = apply
+        self._workers = MemberExecutor(max_backlog or int(env('BRIDGE_MAX_BACKLOG', 1000)))
+        self.batches = 0
+        self.received = 0
+        self.applied = 0
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+
+    async def run(self, queue: asyncio.Queue):
+        while True:
+            batch: List[Message] = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            self.batches += 1
+            self.received += len(batch)
+            for message in batch:
+                await self._workers.submit((message.server_id, message.lobby_name),
+                                           self._run, message)
+
+    async def _run(self, message: Message):
+        try:
+            await self._apply(message)
+        finally:
+            lag = time.time() - message.sent_at
+            self.applied += 1
+            self._lag_total += lag
+            self._lag_max = max(self._lag_max, lag)
+
+    def stats(self) -> Dict[str, Any]:
+        applied = max(self.applied, 1)
+        return {"received": self.received,
+                "applied": self.applied,
+                "avgBatch": round(self.received / max(self.batches, 1), 2),
+                "avgLagMs": round(self._lag_total / applied * 1000, 2),
+                "maxLagMs": round(self._lag_max * 1000, 2),
+                "workers": self._workers.stats()}
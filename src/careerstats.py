@@ -1,58 +1,119 @@
 from btag import Btag
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Dict, Optional
+import asyncio
+import heapq
 import json
 import os
 import os.path
-import urllib.request
 import zipfile
 
+import owapi
+from cache import TTLCache, SingleFlight
+from snapshot_store import make_store
+
+
+"""
+Compact record of the stats we use from an API response
+"""
+
+def _parseDuration(value):
+    """ "hh:mm:ss" / "mm:ss" from the API to seconds """
+    if isinstance(value, (int, float)):
+        return int(value)
+    seconds = 0
+    for part in str(value).split(":"):
+        seconds = seconds * 60 + int(part or 0)
+    return seconds
+
+@dataclass
+class ProfileRecord:
+    name: Optional[str] = None
+    private: bool = False
+    # role -> SR
+    ratings: Dict[str, int] = field(default_factory=dict)
+    # hero -> seconds played in competitive
+    timePlayed: Dict[str, int] = field(default_factory=dict)
+
+    VERSION = 1
+
+    @classmethod
+    def fromApi(cls, data):
+        """ Project a profile/complete API response, None stays None """
+        if data is None:
+            return None
+        ratings = { r["role"]: r["level"] for r in data.get("ratings") or []
+                    if r.get("role") and r.get("level") is not None }
+        topHeroes = (data.get("competitiveStats") or {}).get("topHeroes") or {}
+        timePlayed = { hero: _parseDuration(h.get("timePlayed") or 0)
+                       for hero, h in topHeroes.items() }
+        return cls(data.get("name"), bool(data.get("private")), ratings, timePlayed)
+
+    @classmethod
+    def fromJson(cls, data):
+        """ Load a stored record, older snapshots hold the raw API response """
+        if isinstance(data, dict) and data.get("v") == cls.VERSION:
+            return cls(data["name"], data["private"], data["ratings"], data["timePlayed"])
+        return cls.fromApi(data)
+
+    def toJson(self):
+        return { "v": self.VERSION, "name": self.name, "private": self.private,
+                 "ratings": self.ratings, "timePlayed": self.timePlayed }
 
 """
 Wrapper for stats to enable easy formatting
 """
 
+# Roster of assets/icons/heroes, plus heroes we don't have an icon for yet
+_roles = {
+    "tank": ["dva", "orisa", "reinhardt", "roadhog", "sigma", "winston", "wreckingball", "zarya"],
+    "damage": ["ashe", "bastion", "doomfist", "echo", "genji", "hanzo", "junkrat", "mccree", "mei",
+               "pharah", "reaper", "soldier76", "sombra", "symmetra", "torbjorn", "tracer",
+               "widowmaker"],
+    "support": ["ana", "baptiste", "brigitte", "lucio", "mercy", "moira", "zenyatta"],
+}
+HERO_ROLES = { hero: role for role, heroes in _roles.items() for hero in heroes }
+
+def heroKey(name):
+    """ API hero name ("dVa", "wreckingBall") to icon name ("dva", "wreckingball") """
+    return "".join(c for c in name.lower() if c.isalnum())
+
 class CareerProfile:
-    _heroes = {
-        "tank": ["dva", "orisa", "reinhardt", "roadhog", "sigma", "winston", "wreckingball", "zarya"  ],
-        "damage": ["ashe", "doomfist", "echo", "genji", "hanzo", "junkrat", "mcree", "mei", "pharah", "reaper",
-                   "soldier76", "sombra", "symmetra", "tracer", "widowmaker" ],
-        "support": ["ana", "baptiste", "brigitte", "lucio", "moira", "mercy", "zenyatta" ]
-    }
-    def __init__(self, tag, data):
+    # Heroes shown per role
+    mostPlayedCount = 3
+
+    def __init__(self, tag, record, taken_at=None):
         self._tag = tag
-        self._data = data
-
-    def __getFormattedHack__(self):
-        d = self._data
-        profile = {
-            "tag": self._tag.to_string(),
-            "overview": { }
-        }
-        
-        if not d:
-            d = {}
-        
-        mostPlayed = { "tank": [], "damage": [], "support": [] }
-        for hero, hdata in d.get("competitiveStats", {}).get("topHeroes", {}).items():
-            h = { "hero": hero, "timePlayed": hdata["timePlayed"]}
-            for r in self._heroes.keys():
-                if hero in self._heroes[r]: mostPlayed[r].append(h)
-        
-        for r in self._heroes.keys():
-            profile["overview"][r] = {
-                "sr": None, 
-                "peakSr": None,
-                "mostPlayed": sorted(mostPlayed.get(r,[]), key=lambda x: x["timePlayed"])
+        self._record = record
+        self.taken_at = taken_at
+        self._formatted = None
+
+    def formatted(self):
+        """ Formatted profile, computed once per snapshot """
+        if self._formatted is None:
+            self._formatted = self._format()
+        return self._formatted
+
+    def _format(self):
+        d = self._record or ProfileRecord()
+        byRole = { r: [] for r in _roles }
+        for hero, timePlayed in d.timePlayed.items():
+            key = heroKey(hero)
+            role = HERO_ROLES.get(key)
+            if role:
+                byRole[role].append({ "hero": key, "timePlayed": timePlayed })
+
+        overview = {}
+        for r, heroes in byRole.items():
+            sr = d.ratings.get(r)
+            overview[r] = {
+                "sr": sr,
+                "peakSr": sr,
+                "mostPlayed": heapq.nlargest(self.mostPlayedCount, heroes,
+                                             key=lambda h: h["timePlayed"]),
             }
-            
-        ratings = d.get('ratings')
-        if ratings:
-            for rating in ratings:
-                r = rating["role"]
-                profile["overview"][r]["sr"] = rating["level"]
-                profile["overview"][r]["peakSr"] = rating["level"]
-            
-        return profile
+        return { "tag": self._tag.to_string(), "overview": overview }
         
 """
 Class for managing player database
@@ -60,70 +121,119 @@ Class for managing player database
 
 class CareerDatabase:
 
-    _apiquery = "https://ow-api.com/v1/stats/pc/EU/{}/complete"
-    #_apiquery = "https://ow-api.com/v1/stats/pc/EU/{}/profile"
+    _apiendpoint = "complete"
+    #_apiendpoint = "profile"
     _databaseroot = "players"
     _dummyquery = False
     
-    #TODO: Proper header
-    _hdr = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like Gecko) Chrome/23.0.1271.64 Safari/537.11',
-       'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-       'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3',
-       'Accept-Encoding': 'none',
-       'Accept-Language': 'en-US,en;q=0.8',
-       'Connection': 'keep-alive' }
-    
-    def __init__(self):
+    def __init__(self, client=None):
         self._databaseroot = os.environ.get('DATABASE_ROOT', self._databaseroot)
+        self._client = client or owapi.client
+        self._store = make_store(self._databaseroot)
+        # Full API responses are only kept if asked for
+        self._rawarchive = os.environ.get('PROFILE_RAW_ARCHIVE')
+        self._cache = TTLCache(int(os.environ.get('PROFILE_CACHE_SIZE', 1024)),
+                               float(os.environ.get('PROFILE_CACHE_TTL', 600)))
+        self._inflight = SingleFlight()
         
-    async def getStats(self, btag, force_update=False):
-        if self._tagInDatabase(btag) and not force_update:
-            stats = await self._getFromDataBase(btag)
+    async def getStats(self, btag, force_update=False,
+                       priority=owapi.OwApiClient.PRIORITY_JOIN):
+        key = btag.to_string()
+        if force_update:
+            self._cache.invalidate(key)
         else:
-            stats = await self._queryApi(btag)
-            await self._saveToDataBase(btag, stats)
+            stats = self._cache.get(key)
+            if stats is not None:
+                return stats
+            # A forced refresh already running gives fresher data than disk
+            refresh = self._inflight.pending((key, True))
+            if refresh is not None:
+                return await asyncio.shield(refresh)
+
+        return await self._inflight.do((key, force_update), self._loadStats,
+                                       btag, force_update, priority)
+
+    async def _loadStats(self, btag, force_update, priority):
+        key = btag.to_string()
+        snapshot = None
+        if not force_update:
+            snapshot = await self._getFromDataBase(btag)
+        if snapshot is None:
+            data = await self._queryApi(btag, priority)
+            if data is None and force_update:
+                # Keep what we had rather than replacing it with nothing
+                snapshot = await self._getFromDataBase(btag)
+            if snapshot is None:
+                snapshot = await self._ingest(btag, data)
             
-        stats = CareerProfile(btag, stats)
+        taken_at, record = snapshot
+        stats = CareerProfile(btag, record, taken_at)
+        self._cache.put(key, stats)
+        return stats
+
+    async def seed(self, btag, data):
+        """ Store a complete API response fetched elsewhere (e.g. btag validation) """
+        taken_at, record = await self._ingest(btag, data)
+        self._cache.put(btag.to_string(), CareerProfile(btag, record, taken_at))
+
+    def invalidate(self, btag):
+        """ Drop a player from the in-memory cache """
+        self._cache.invalidate(btag.to_string())
+
+    def cacheStats(self):
+        stats = self._cache.stats()
+        stats["inflight"] = len(self._inflight)
+        stats["coalesced"] = self._inflight.coalesced
         return stats
         
-    async def _queryApi(self, btag):
+    async def _queryApi(self, btag, priority=owapi.OwApiClient.PRIORITY_JOIN):
         if self._dummyquery:
             return { "dummyquery": "dummyval3"}
         else:
-            try:
-                query = self._apiquery.format(btag.for_api())
-                request = urllib.request.Request(query, None, self._hdr)
-                response = urllib.request.urlopen(request).read()
-            except urllib.error.HTTPError:
-                return None
-            data = json.loads(response.decode('utf-8'))
-            return data
+            return await self._client.fetch(btag, self._apiendpoint, priority)
         
     def _update(self, btag):
         " Query api-server for updated stats "
         pass
         
-    def _tagInDatabase(self, btag):
-        return os.path.exists(os.path.join(self._databaseroot, btag.to_string()))
+    async def _ingest(self, btag, data):
+        """ Store the compact record of an API response """
+        taken_at = datetime.now()
+        record = ProfileRecord.fromApi(data)
+        if self._rawarchive and data is not None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._archiveRaw, btag, data, taken_at)
+        await self._saveToDataBase(btag, record, taken_at)
+        return taken_at, record
+
+    def _archiveRaw(self, btag, data, taken_at):
+        os.makedirs(self._rawarchive, exist_ok=True)
+        fname = os.path.join(self._rawarchive, btag.to_string() + ".zip")
+        with zipfile.ZipFile(fname, 'a', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(taken_at.strftime("%Y-%m-%d_%H%M%S%f") + ".json",
+                             json.dumps(data))
         
     async def _getFromDataBase(self, btag):
-        playerdir = os.path.join(self._databaseroot, btag.to_string())
-        files = sorted(os.listdir(playerdir))
-        with open(os.path.join(playerdir, files[-1]), 'r') as file:
-            data = json.load(file)
-        return data
+        snapshot = await self._store.latest(btag.to_string())
+        if snapshot is None:
+            return None
+        taken_at, data = snapshot
+        return taken_at, ProfileRecord.fromJson(data)
         
-    async def _saveToDataBase(self, btag, data):
-        playerdir = os.path.join(self._databaseroot, btag.to_string())
-        full_path = os.path.abspath(playerdir)
-        if not os.path.exists(playerdir):
-            os.makedirs(playerdir)
-            
-        fname = datetime.now().strftime("%d-%m-%Y_%H%M%S") + ".json"
-        with open(os.path.join(playerdir, fname), 'x') as file:
-            file.write(json.dumps(data))
+    async def _saveToDataBase(self, btag, record, taken_at=None):
+        data = record.toJson() if record is not None else None
+        await self._store.save(btag.to_string(), data, taken_at)
         return True
+
+    async def close(self):
+        await self._store.close()
         
+careerDatabase = CareerDatabase()
+
 if __name__ == "__main__":
-    db = CareerDatabase()
-    print(db.getStats(Btag("flasheart#21119")))
+    async def _main():
+        db = careerDatabase
+        print((await db.getStats(Btag("flasheart#21119"))).formatted())
+        await db.close()
+        await owapi.client.close()
+    asyncio.run(_main())
@@ -2,7 +2,7 @@
 
 import logging
 from commands import Command
-from typing import List, Dict, Union, Optional
+from typing import Iterable, List, Dict, Union, Optional
 from guildconf import LobbyVC
 import helper
 from bot import MyClient
@@ -30,6 +30,7 @@ class CfgReactionHandler:
         self.vcs: List[discord.VoiceChannel] = []
         self.name = name
         self.logger = helper.default_logger("CfgReactionHandler-{}".format(name), logging.DEBUG)
+        self.client = client
         self.config = client.config
         self.logger.info("Creating reaction handler")
         self.logger.debug("Buttons: %s",
@@ -61,15 +62,15 @@ class CfgReactionHandler:
             return False
         self.vcs.append(self.entry.voice_chan[emoji])
         self.logger.debug("%d channel registered", len(self.vcs))
-        await reaction.message.edit(content=self._format_update_msg())
+        self.client.outbox.edit(reaction.message, self._format_update_msg())
         if len(self.vcs) >= 3 and reaction.message.guild:
-            (self.config[reaction.message.guild.id]
-             .lobbies
-             .update({self.name: LobbyVC(self.name,
-                                          self.vcs[0].id,
-                                          self.vcs[1].id,
-                                          self.vcs[2].id)}))
-            helper.save_config(self.config)
+            guild_config = self.config[reaction.message.guild.id]
+            guild_config.lobbies.update({self.name: LobbyVC(self.name,
+                                                            self.vcs[0].id,
+                                                            self.vcs[1].id,
+                                                            self.vcs[2].id)})
+            # Saves the guild and reindexes its channels
+            self.config.put(guild_config)
             self.logger.debug("Updating configuration")
             return True
         return False
@@ -88,12 +89,12 @@ class CfgReactionHandler:
         self.logger.debug("Selecting categories")
         self.entry = self.buttons[emoji]
         self.logger.debug("Clearing reactions")
-        await reaction.message.clear_reactions()
+        self.client.outbox.clear_reactions(reaction.message)
         self.logger.debug("Editing content")
-        await reaction.message.edit(content=self._format_msg())
+        self.client.outbox.edit(reaction.message, self._format_msg())
         self.logger.debug("Adding new reactions")
         for r in self.entry.voice_chan:
-            await reaction.message.add_reaction(r)
+            self.client.outbox.add_reaction(reaction.message, r)
         return False
 
 
@@ -121,7 +122,7 @@ class CmdConfigPrint(Command):
         __Team 2__: <#{}>
         """.format(lobby.name, lobby.lobby, lobby.team1, lobby.team2)
 
-    def _format_lobbies(self, lobbies: List[LobbyVC]):
+    def _format_lobbies(self, lobbies: Iterable[LobbyVC]):
         return "\n".join([self._format_lobby(l) for l in lobbies])
 
     async def execute(self, message: discord.Message, args: List[str]):
@@ -140,7 +141,7 @@ class CmdConfigPrint(Command):
 {}
         """.format(guild_name, self.client().config[guild.id].prefix,
                    self._format_lobbies(self.client().config[guild.id].lobbies.values()))
-        await chan.send(res_str)
+        self.client().outbox.send(chan, res_str)
 
         
 class CmdConfigBot(Command):
@@ -171,7 +172,7 @@ class CmdConfigBot(Command):
         self.logger.info("Executing command")
         guild = message.guild
         if len(args) < 1:
-            await message.channel.send('Not enough arguments')
+            self.client().outbox.send(message.channel, 'Not enough arguments')
             return
         if not guild:
             return
@@ -188,7 +189,9 @@ class CmdConfigBot(Command):
             elif isinstance(cat.cat, discord.CategoryChannel):
                 res += "{} <#{}>\n".format(emoji, cat.cat.id)
         chan = message.channel
-        message = await chan.send("voice channels:\n{}".format(res))
+        message = await self.client().outbox.send(chan, "voice channels:\n{}".format(res))
+        if not message:
+            return
         for r in reactions:
-            await message.add_reaction(r)
+            self.client().outbox.add_reaction(message, r)
         self.client().reaction_callbacks[message.id] = CfgReactionHandler(self.client(), args[0], reactions)
@@ -0,0 +1,150 @@
+"""
+Persistent store of the guild configs
+"""
+
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import helper
+from guildconf import GuildConfig, LobbyVC
+from ratelimit import backoff
+
+
+Listener = Callable[[GuildConfig], None]
+
+_schema = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+_upsert = "INSERT OR REPLACE INTO guilds (guild_id, data) VALUES (?, ?)"
+
+
+def encode(cfg: GuildConfig) -> str:
+    return json.dumps({"guild_id": cfg.guild_id,
+                       "prefix": cfg.prefix,
+                       "lobbies": [vars(lobby) for lobby in cfg.lobbies.values()]})
+
+
+def decode(data: str) -> GuildConfig:
+    raw: Dict[str, Any] = json.loads(data)
+    lobbies = {l['name']: LobbyVC(l['name'], l['lobby'], l['team1'], l['team2'])
+               for l in raw['lobbies']}
+    return GuildConfig(raw['guild_id'], lobbies, raw['prefix'])
+
+
+class GuildConfigStore:
+    """
+    Guild id -> GuildConfig, kept in memory and saved in SQLite one
+    row per guild. `put` replaces the config of a guild, tells the
+    listeners and queues its row; queued rows are written together in
+    one transaction off the event loop.
+    The first time, the configs are imported from the legacy config.json.
+    """
+
+    def __init__(self, path: Optional[str] = None, flush_delay: float = 0.5):
+        root = os.environ.get('DATABASE_ROOT', ".")
+        self.path: str = (path or os.environ.get('CONFIG_DB')
+                          or os.path.join(root, "config.sqlite3"))
+        self.flush_delay = flush_delay
+        self.logger = helper.default_logger("GuildConfigStore", logging.INFO)
+        self.guilds: Dict[int, GuildConfig] = {}
+        self._listeners: List[Listener] = []
+        # Guilds changed since the last flush
+        self._dirty: Dict[int, GuildConfig] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Flushes failed in a row
+        self._failures = 0
+        # sqlite connections are used from a single dedicated thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor.submit(self._load).result()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # A config change is rare, make sure it survives a crash
+            self._conn.execute("PRAGMA synchronous=FULL")
+            self._conn.executescript(_schema)
+        return self._conn
+
+    def _load(self):
+        conn = self._connection()
+        for guild_id, data in conn.execute("SELECT guild_id, data FROM guilds"):
+            self.guilds[guild_id] = decode(data)
+        if not self.guilds:
+            legacy = helper.load_config()
+            if legacy:
+                self._write([(cfg.guild_id, encode(cfg)) for cfg in legacy.values()])
+                self.guilds.update(legacy)
+                self.logger.info("Imported %d guilds from config.json", len(legacy))
+        self.logger.info("Loaded %d guild configs", len(self.guilds))
+
+    def _write(self, rows: List[Tuple[int, str]]):
+        conn = self._connection()
+        with conn:
+            conn.executemany(_upsert, rows)
+
+    def subscribe(self, listener: Listener):
+        """Call `listener` with every config put in the store"""
+        self._listeners.append(listener)
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self.guilds
+
+    def __getitem__(self, guild_id: int) -> GuildConfig:
+        return self.guilds[guild_id]
+
+    def get(self, guild_id: int) -> Optional[GuildConfig]:
+        return self.guilds.get(guild_id)
+
+    def put(self, cfg: GuildConfig):
+        """Add or replace the config of a guild"""
+        self.guilds[cfg.guild_id] = cfg
+        for listener in self._listeners:
+            listener(cfg)
+        self._dirty[cfg.guild_id] = cfg
+        if self._flush_handle is None:
+            self._schedule_flush(self.flush_delay)
+
+    def _schedule_flush(self, delay: float):
+        loop = asyncio.get_event_loop()
+        self._flush_handle = loop.call_later(
+            delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        # Encoded now so that the writer thread never sees a config being changed
+        rows = [(guild_id, encode(cfg)) for guild_id, cfg in dirty.items()]
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._write, rows)
+        except sqlite3.Error:
+            self.logger.exception("Could not write %d guild configs", len(rows))
+            dirty.update(self._dirty)
+            self._dirty = dirty
+            # Don't wait for the next change to try again
+            self._failures += 1
+            self._schedule_flush(backoff(self._failures, self.flush_delay))
+            return
+        self._failures = 0
+
+    async def close(self):
+        await self.flush()
+        if self._conn is not None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self._executor, self._conn.close)
+            self._conn = None
@@ -14,16 +14,8 @@ def default_logger(name, level):
     logger.addHandler(handler)
     return logger
 
-class MyEncoder(json.JSONEncoder):
-        def default(self, o):
-            return o.__dict__
-
-def save_config(config):
-    root = os.environ.get('DATABASE_ROOT', ".")
-    filename = os.path.join(root, "config.json")
-    with open(filename, "w") as cfgfile:
-        cfgfile.write(MyEncoder().encode(config))
 def load_config():
+    """Read the legacy config.json, imported by config_store.GuildConfigStore"""
     root = os.environ.get('DATABASE_ROOT', ".")
     filename = os.path.join(root, "config.json")
     if not os.path.exists(filename):
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of lobby update broadcasts against the number of viewers
+
+Broadcasts a player-join carrying a full profile to N subscriptions,
+encoding it for each subscriber (as the SSE stream used to) and once
+for all of them (GameLobby._broadcast), then reads every frame back:
+    python src/helper/bench_broadcast.py --subscribers 1 10 100 1000
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_owapi
+
+
+def make_message(index: int) -> dict:
+    from btag import Btag
+    from careerstats import CareerProfile, ProfileRecord
+    tag = Btag("Viewer{}#{}".format(index, 1000 + index))
+    record = ProfileRecord.fromApi(fake_owapi.make_profile(tag.for_api(), True))
+    return {"event": "player-join",
+            "data": {"playerData": {"id": str(index),
+                                    "title": tag.name,
+                                    "group": "waiting",
+                                    "selectedRoles": ["tank", "damage", "support"],
+                                    "profileData": CareerProfile(tag, record).formatted()}}}
+
+
+def per_subscriber(lobby, msg: dict):
+    # What every SSE stream did with the message it got
+    for subscription in list(lobby.messageBus._listeners):
+        frame = "data: {}\n\n".format(json.dumps(msg)).encode('utf-8')
+        subscription._push(frame)
+
+
+def serialize_once(lobby, msg: dict):
+    lobby._broadcast(msg)
+
+
+async def drain(subscriptions):
+    for subscription in subscriptions:
+        await subscription.get()
+
+
+async def measure(broadcast, subscribers: int, rounds: int) -> float:
+    from lobby import GameLobby
+    lobby = GameLobby()
+    subscriptions = [lobby.listenForUpdates() for _ in range(subscribers)]
+    messages = [make_message(i) for i in range(rounds)]
+    start = time.perf_counter()
+    for msg in messages:
+        broadcast(lobby, msg)
+        await drain(subscriptions)
+    elapsed = (time.perf_counter() - start) / rounds
+    for subscription in subscriptions:
+        subscription.close()
+    return elapsed
+
+
+async def main(args):
+    print("{:>11} {:>18} {:>18} {:>8}".format(
+        "subscribers", "per-sub (us/msg)", "once (us/msg)", "speedup"))
+    for count in args.subscribers:
+        before = await measure(per_subscriber, count, args.rounds)
+        after = await measure(serialize_once, count, args.rounds)
+        print("{:>11} {:>18.1f} {:>18.1f} {:>7.1f}x".format(
+            count, before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,135 @@
+"""
+End-to-end latency benchmark of the profile pipeline
+
+Starts the fake ow-api (fake_owapi.py) on a local port and drives
+CareerDatabase.getStats, GameLobby.playerJoin and
+MyClient._check_btag_exists against it, reporting p50/p99 latency
+and throughput for cold cache, warm cache and concurrent joins:
+    python src/helper/bench_profiles.py --players 50 --latency 0.2
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from typing import Awaitable, Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_owapi
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def measure(name: str, calls: List[Callable[[], Awaitable]],
+                  concurrency: int):
+    """Run `calls` with at most `concurrency` in flight and print a report line"""
+    import owapi
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    sent = owapi.client.sent
+
+    async def timed(call):
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[timed(call) for call in calls])
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>6} {:>9.1f} {:>9.1f} {:>10.1f} {:>9}".format(
+        name, len(calls),
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        len(calls) / elapsed, owapi.client.sent - sent))
+
+
+async def run(args):
+    # Import once the environment points at the fake server
+    import owapi
+    import lobby
+    from btag import Btag
+    from careerstats import CareerDatabase
+
+    tags = [Btag("Player{}#{}".format(i, 1000 + i)) for i in range(args.players)]
+    print("{:<28} {:>6} {:>9} {:>9} {:>10} {:>9}".format(
+        "scenario", "calls", "p50 (ms)", "p99 (ms)", "ops/s", "upstream"))
+
+    db = CareerDatabase()
+    await measure("getStats cold",
+                  [lambda t=t: db.getStats(t) for t in tags], args.concurrency)
+    await measure("getStats warm (memory)",
+                  [lambda t=t: db.getStats(t) for t in tags], args.concurrency)
+    await db.close()
+    db = CareerDatabase()
+    await measure("getStats warm (store)",
+                  [lambda t=t: db.getStats(t) for t in tags], args.concurrency)
+    burst = Btag("Burst#1")
+    await measure("getStats same btag burst",
+                  [lambda: db.getStats(burst) for _ in tags], len(tags))
+    await db.close()
+
+    cold_tags = [Btag("Joiner{}#{}".format(i, 1000 + i)) for i in range(args.players)]
+    game = lobby.GameLobby()
+    await game.lobbySetUp()
+    await measure("playerJoin concurrent cold",
+                  [lambda i=i, t=t: game.playerJoin(i, t.to_string(), name=t.name)
+                   for i, t in enumerate(cold_tags)], len(cold_tags))
+    await measure("playerJoin concurrent warm",
+                  [lambda i=i, t=t: game.playerJoin(i, t.to_string(), name=t.name)
+                   for i, t in enumerate(cold_tags)], len(cold_tags))
+
+    import bot
+    client = bot.MyClient(asyncio.Queue())
+    valid = [Btag("Valid{}#{}".format(i, 1000 + i)) for i in range(args.players)]
+    unknown = [Btag("Unknown{}#{}".format(i, 1000 + i)) for i in range(args.players)]
+    await measure("_check_btag_exists valid",
+                  [lambda t=t: client._check_btag_exists(t) for t in valid],
+                  args.concurrency)
+    await measure("_check_btag_exists unknown",
+                  [lambda t=t: client._check_btag_exists(t) for t in unknown],
+                  args.concurrency)
+    await measure("_check_btag_exists repeat",
+                  [lambda t=t: client._check_btag_exists(t) for t in valid],
+                  args.concurrency)
+
+    await lobby.careerDatabase.close()
+    await owapi.client.close()
+
+
+async def main(args):
+    stop = asyncio.Event()
+    server = asyncio.ensure_future(fake_owapi.serve(
+        args.port, args.latency, args.jitter, args.error_rate, stop.wait))
+    await asyncio.sleep(0.5)
+    try:
+        await run(args)
+    finally:
+        stop.set()
+        await server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--players", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="ow-api requests per second allowed by the client")
+    args = parser.parse_args()
+
+    os.environ['OWAPI_ROOT'] = "http://127.0.0.1:{}/v1/stats/pc/EU".format(args.port)
+    os.environ['OWAPI_RATE'] = str(args.rate)
+    os.environ['OWAPI_BURST'] = str(args.rate)
+    os.environ.setdefault('DATABASE_ROOT', tempfile.mkdtemp(prefix="pugbot-bench-"))
+    asyncio.run(main(args))
@@ -0,0 +1,89 @@
+"""
+Local stand-in for ow-api.com serving canned profiles
+
+Serves /v1/stats/pc/<region>/<tag>/profile and /complete with
+a configurable latency and error rate, e.g.:
+    python src/helper/fake_owapi.py --port 8089 --latency 0.3 --error-rate 0.05
+then run the bot with OWAPI_ROOT=http://127.0.0.1:8089/v1/stats/pc/EU
+"""
+
+import argparse
+import asyncio
+import random
+
+from quart import Quart
+
+app = Quart(__name__)
+app.config.update(LATENCY=0.0, JITTER=0.0, ERROR_RATE=0.0, PAD=200)
+
+_roles = {
+    "tank": ["dVa", "orisa", "reinhardt", "roadhog", "sigma", "winston", "wreckingBall", "zarya"],
+    "damage": ["ashe", "doomfist", "echo", "genji", "hanzo", "junkrat", "mccree", "mei", "pharah",
+               "reaper", "soldier76", "sombra", "symmetra", "torbjorn", "tracer", "widowmaker"],
+    "support": ["ana", "baptiste", "brigitte", "lucio", "mercy", "moira", "zenyatta"],
+}
+
+
+def _duration(rng: random.Random) -> str:
+    seconds = rng.randint(60, 200 * 3600)
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def make_profile(tag: str, complete: bool, pad: int = 200) -> dict:
+    """Deterministic fake profile of `tag`, shaped like ow-api's"""
+    rng = random.Random(tag)
+    name = tag.replace('-', '#')
+    ratings = [{"level": rng.randint(1000, 4500), "role": role,
+                "roleIcon": "", "rankIcon": ""}
+               for role in _roles if rng.random() < 0.8]
+    profile = {"name": name, "level": rng.randint(1, 100), "prestige": rng.randint(0, 10),
+               "private": False, "rating": 0, "ratings": ratings,
+               "icon": "", "endorsement": 3, "gamesWon": rng.randint(0, 2000)}
+    if not complete:
+        return profile
+    heroes = [h for heroes in _roles.values() for h in heroes]
+    top_heroes = {hero: {"timePlayed": _duration(rng),
+                         "gamesWon": rng.randint(0, 500),
+                         "winPercentage": rng.randint(0, 100),
+                         "weaponAccuracy": rng.randint(0, 100),
+                         "eliminationsPerLife": rng.random() * 3,
+                         "multiKillBest": rng.randint(0, 6),
+                         "objectiveKills": rng.random() * 20}
+                  for hero in heroes if rng.random() < 0.6}
+    # The real payload carries hundreds of counters per hero
+    career = {hero: {"stat{}".format(i): rng.random() for i in range(pad)}
+              for hero in top_heroes}
+    profile["competitiveStats"] = {"topHeroes": top_heroes, "careerStats": career}
+    profile["quickPlayStats"] = {"topHeroes": top_heroes, "careerStats": career}
+    return profile
+
+
+@app.route('/v1/stats/pc/<region>/<tag>/<endpoint>')
+async def stats(region, tag, endpoint):
+    cfg = app.config
+    await asyncio.sleep(max(0.0, random.gauss(cfg["LATENCY"], cfg["JITTER"])))
+    if random.random() < cfg["ERROR_RATE"]:
+        return ({"error": "Overloaded"}, random.choice([429, 503]))
+    if endpoint not in ("profile", "complete"):
+        return ({"error": "Not found"}, 404)
+    if tag.lower().startswith("unknown"):
+        return ({"error": "Player not found"}, 404)
+    return make_profile(tag, endpoint == "complete", cfg["PAD"])
+
+
+async def serve(port: int, latency: float = 0.0, jitter: float = 0.0,
+                error_rate: float = 0.0, shutdown_trigger=None):
+    app.config.update(LATENCY=latency, JITTER=jitter, ERROR_RATE=error_rate)
+    await app.run_task(host="127.0.0.1", port=port,
+                       shutdown_trigger=shutdown_trigger)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.3, help="mean latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="latency std deviation (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.latency, args.jitter, args.error_rate))
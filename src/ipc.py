@@ -0,0 +1,274 @@
+"""
+Local socket transport of the bot's messages to server processes
+
+The bot (BOT_ONLY) runs a Publisher on the unix socket IPC_PATH, every
+server process (SERVER_ONLY) connects to it with a Subscriber feeding
+its lobbies. Messages are sent as compact JSON arrays, one per line:
+    ["J", seq, player, [btags], server_id, lobby_name, nick, sent_at]
+    ["L", seq, player, server_id, lobby_name, sent_at]
+A subscriber starts by sending the epoch (bot run) and sequence number
+of the last message it got and the publisher replays what it missed
+from its recent history after its hello:
+    ["H", epoch]
+When the history doesn't cover it anymore (or it comes from another
+run) the subscriber is resynced instead: the publisher sends the joins
+of every player currently in a lobby, as of sequence number seq,
+    ["H", epoch, seq, count]
+followed by the `count` joins, and the subscriber makes the players it
+knew of but aren't part of it leave.
+"""
+
+import os
+import json
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict as odict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, Union
+
+import helper
+import sharding
+from btag import Btag
+from messages import PlayerJoined, PlayerLeft
+from ratelimit import backoff
+
+
+Message = Union[PlayerJoined, PlayerLeft]
+
+
+def default_path() -> str:
+    root = os.environ.get('DATABASE_ROOT', ".")
+    return sharding.per_process(os.environ.get('IPC_PATH', os.path.join(root, "pugbot.sock")))
+
+
+def _dumps(record: list) -> bytes:
+    return json.dumps(record, separators=(",", ":")).encode() + b"\n"
+
+
+def encode(seq: int, message: Message) -> bytes:
+    if isinstance(message, PlayerJoined):
+        return _dumps(["J", seq, message.player,
+                       [btag.to_string() for btag in message.btags],
+                       message.server_id, message.lobby_name, message.nick,
+                       message.sent_at])
+    return _dumps(["L", seq, message.player, message.server_id,
+                   message.lobby_name, message.sent_at])
+
+
+def decode(line: bytes) -> Tuple[int, Message]:
+    record = json.loads(line)
+    message: Message
+    if record[0] == "J":
+        _, seq, player, btags, server_id, lobby_name, nick, sent_at = record
+        message = PlayerJoined(player, odict((Btag(b), True) for b in btags),
+                               server_id, lobby_name, nick)
+    else:
+        _, seq, player, server_id, lobby_name, sent_at = record
+        message = PlayerLeft(player, server_id, lobby_name)
+    # Keep the bot's time so that the lag covers the transport
+    message.sent_at = sent_at
+    return seq, message
+
+
+class _Connection:
+    def __init__(self, writer: asyncio.StreamWriter, size: int):
+        self.writer = writer
+        self.lines: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self.dropped = False
+
+
+class Publisher:
+    """
+    Stand-in for the bot's backend queue sending every message to all
+    the connected subscribers. The last `history` messages are kept
+    for replay. A subscriber too slow to keep up with `backlog` pending
+    messages is disconnected, it will catch up when reconnecting.
+    `snapshot` gives the joins subscribers past the history are resynced
+    with, without it they only get what is left.
+    """
+
+    def __init__(self, path: Optional[str] = None,
+                 history: Optional[int] = None, backlog: Optional[int] = None,
+                 snapshot: Optional[Callable[[], List[Message]]] = None):
+        env = os.environ.get
+        self.path = path or default_path()
+        self.backlog = backlog or int(env('IPC_BACKLOG', 10000))
+        self.logger = helper.default_logger("IpcPublisher", logging.INFO)
+        self.epoch = uuid.uuid4().hex
+        self._seq = 0
+        self._history: Deque[Tuple[int, bytes]] = deque(
+            maxlen=history or int(env('IPC_HISTORY', 10000)))
+        self._connections: Set[_Connection] = set()
+        self.snapshot = snapshot
+        self.dropped = 0
+        self.resyncs = 0
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            try:
+                _, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                # Left behind by a previous run
+                os.unlink(self.path)
+            else:
+                writer.close()
+                raise RuntimeError("{} is already served by another bot".format(self.path))
+        server = await asyncio.start_unix_server(self._accept, path=self.path)
+        self.logger.info("Publishing on %s", self.path)
+        async with server:
+            await server.serve_forever()
+
+    async def put(self, message: Message):
+        self._seq += 1
+        line = encode(self._seq, message)
+        self._history.append((self._seq, line))
+        for conn in list(self._connections):
+            try:
+                conn.lines.put_nowait(line)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                self.logger.warning("Subscriber too slow, disconnecting it")
+                self._connections.discard(conn)
+                conn.dropped = True
+
+    def _missed(self, epoch: str, seq: int) -> List[bytes]:
+        """Hello and lines bringing a subscriber up to date"""
+        if epoch != self.epoch:
+            # Subscriber new or from a previous run, it may hold players
+            # this run never heard of
+            seq = 0
+            gap = True
+        else:
+            gap = bool(self._history) and self._history[0][0] > seq + 1
+        if gap and self.snapshot is not None:
+            self.resyncs += 1
+            joins = [encode(self._seq, message) for message in self.snapshot()]
+            return [_dumps(["H", self.epoch, self._seq, len(joins)])] + joins
+        if gap and self._history and self._history[0][0] > seq + 1:
+            self.logger.warning("Subscriber missed %d messages not kept anymore",
+                                self._history[0][0] - seq - 1)
+        return [_dumps(["H", self.epoch])] + [line for line_seq, line in self._history
+                                              if line_seq > seq]
+
+    async def _accept(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        conn = _Connection(writer, self.backlog)
+        try:
+            epoch, seq = json.loads(await reader.readline())
+            missed = self._missed(epoch, seq)
+            # Registered before yielding so that no message falls in between
+            self._connections.add(conn)
+            writer.writelines(missed)
+            self.logger.info("Subscriber connected, sending %d messages", len(missed) - 1)
+            while True:
+                line = await conn.lines.get()
+                if conn.dropped:
+                    break
+                writer.write(line)
+                # Batch whatever else is ready before waiting on the socket
+                while not conn.lines.empty():
+                    writer.write(conn.lines.get_nowait())
+                await writer.drain()
+        except (ConnectionError, ValueError) as err:
+            self.logger.info("Subscriber disconnected: %s", err)
+        finally:
+            self._connections.discard(conn)
+            writer.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"seq": self._seq,
+                "subscribers": len(self._connections),
+                "backlog": [conn.lines.qsize() for conn in self._connections],
+                "dropped": self.dropped,
+                "resyncs": self.resyncs}
+
+
+class Subscriber:
+    """Receive the messages of a Publisher into `queue`, reconnecting when lost"""
+
+    def __init__(self, queue: asyncio.Queue, path: Optional[str] = None,
+                 retry_base: float = 0.5):
+        self.path = path or default_path()
+        self.queue = queue
+        self.retry_base = retry_base
+        self.logger = helper.default_logger("IpcSubscriber", logging.INFO)
+        self.epoch = ""
+        self.seq = 0
+        self.received = 0
+        self.reconnects = 0
+        self.resyncs = 0
+        # Lobby of the players forwarded as joined, by (player, server)
+        self._lobbies: Dict[Tuple[str, int], str] = {}
+
+    async def run(self):
+        attempt = 0
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError as err:
+                attempt += 1
+                delay = backoff(attempt, self.retry_base, cap=10.0)
+                self.logger.warning("Cannot connect to %s (%s), retrying in %.1fs",
+                                    self.path, err, delay)
+                await asyncio.sleep(delay)
+                continue
+            attempt = 0
+            try:
+                await self._receive(reader, writer)
+            except (ConnectionError, ValueError) as err:
+                self.logger.warning("Connection lost: %s", err)
+            finally:
+                writer.close()
+            self.reconnects += 1
+
+    async def _receive(self, reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter):
+        writer.write(_dumps([self.epoch, self.seq]))
+        await writer.drain()
+        hello = json.loads(await reader.readline())
+        if hello[1] != self.epoch:
+            self.logger.info("Publisher restarted, starting over")
+            self.epoch, self.seq = hello[1], 0
+        if len(hello) > 2:
+            await self._resync(reader, hello[2], hello[3])
+        while True:
+            seq, message = decode(await self._readline(reader))
+            if seq <= self.seq:
+                continue
+            self.seq = seq
+            await self._forward(message)
+
+    async def _readline(self, reader: asyncio.StreamReader) -> bytes:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("closed by the publisher")
+        return line
+
+    async def _resync(self, reader: asyncio.StreamReader, seq: int, count: int):
+        joins = [decode(await self._readline(reader))[1] for _ in range(count)]
+        self.logger.info("Resyncing on %d players in lobbies", len(joins))
+        current = {(message.player, message.server_id) for message in joins}
+        for (player, server_id), lobby_name in list(self._lobbies.items()):
+            if (player, server_id) not in current:
+                await self._forward(PlayerLeft(player, server_id, lobby_name))
+        for message in joins:
+            await self._forward(message)
+        self.seq = seq
+        self.resyncs += 1
+
+    async def _forward(self, message: Message):
+        key = (message.player, message.server_id)
+        if isinstance(message, PlayerJoined):
+            self._lobbies[key] = message.lobby_name
+        elif self._lobbies.get(key) == message.lobby_name:
+            del self._lobbies[key]
+        self.received += 1
+        # Waits when the server is behind, the publisher sees it on the socket
+        await self.queue.put(message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"epoch": self.epoch,
+                "seq": self.seq,
+                "received": self.received,
+                "reconnects": self.reconnects,
+                "resyncs": self.resyncs}
@@ -1,61 +1,280 @@
+import os
+import json
+import uuid
 import asyncio
-
-from queue import Queue
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
 
 from btag import Btag
-from careerstats import CareerDatabase
+from careerstats import careerDatabase
+from profile_refresher import ProfileRefresher
+
+
+def sseFrame(msg, eventId: Optional[str] = None) -> bytes:
+    """ Server-sent event carrying `msg`, ready to be written as is """
+    data = b"data: " + json.dumps(msg, separators=(",", ":")).encode('utf-8') + b"\n\n"
+    if eventId is None:
+        return data
+    return b"id: " + eventId.encode('utf-8') + b"\n" + data
+
+
+class Subscription:
+    """
+    Frames broadcast on a MessageBus since subscribing. get() waits
+    for the next one and returns None once closed; closing (also done
+    when leaving a `with` block) unsubscribes right away.
+    A subscriber falling more than `maxsize` frames or `maxbytes` bytes
+    behind has its pending frames replaced by a single state-sync,
+    made when it reads it.
+    """
+
+    def __init__(self, bus: "MessageBus", maxsize: int, maxbytes: int):
+        self._bus = bus
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._messages: Deque[bytes] = deque()
+        self._bytes = 0
+        self._ready = asyncio.Event()
+        self.lagging = False
+        self.closed = False
+
+    def _push(self, frame: bytes) -> bool:
+        if self.lagging:
+            # Covered by the state-sync it will get
+            return True
+        if (len(self._messages) >= self.maxsize
+                or self._bytes + len(frame) > self.maxbytes):
+            return False
+        self._messages.append(frame)
+        self._bytes += len(frame)
+        self._ready.set()
+        return True
+
+    def _resync(self):
+        self._messages.clear()
+        self._bytes = 0
+        self.lagging = True
+        self._ready.set()
+
+    async def get(self) -> Optional[bytes]:
+        while not self._messages:
+            if self.lagging:
+                self.lagging = False
+                return self._bus.snapshot()
+            if self.closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        frame = self._messages.popleft()
+        self._bytes -= len(frame)
+        return frame
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.lagging = False
+            self._bus._unsubscribe(self)
+            self._ready.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class MessageBus:
-    """ https://maxhalford.github.io/blog/flask-sse-no-deps/"""
+    """Broadcast lobby updates to every subscription, without threads.
+    Updates are encoded frames shared by all the subscriptions.
+    `snapshot` makes the state-sync frame sent to lagging subscribers,
+    without it they are closed and left to reconnect."""
 
-    def __init__(self):
-        self._listeners = []
+    def __init__(self, snapshot: Optional[Callable[[], bytes]] = None,
+                 maxsize: Optional[int] = None, maxbytes: Optional[int] = None):
+        self._snapshot = snapshot
+        self.maxsize = maxsize or int(os.environ.get('SSE_MAX_PENDING', 100))
+        self.maxbytes = maxbytes or int(os.environ.get('SSE_MAX_PENDING_BYTES', 256 * 1024))
+        self._listeners: Set[Subscription] = set()
+        self.resyncs = 0
+
+    def listen(self, backlog: Iterable[bytes] = ()) -> Subscription:
+        """ Subscribe, starting with the frames of `backlog` """
+        subscription = Subscription(self, self.maxsize, self.maxbytes)
+        self._listeners.add(subscription)
+        for frame in backlog:
+            self._push(subscription, frame)
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        self._listeners.discard(subscription)
+
+    def _push(self, subscription: Subscription, frame: bytes):
+        if subscription._push(frame):
+            return
+        if self._snapshot is None:
+            subscription.close()
+        else:
+            self.resyncs += 1
+            subscription._resync()
+
+    def snapshot(self) -> bytes:
+        assert self._snapshot
+        return self._snapshot()
+
+    def broadcast(self, frame: bytes):
+        for subscription in list(self._listeners):
+            self._push(subscription, frame)
+
+    def __len__(self) -> int:
+        return len(self._listeners)
+
+
+class PlayerStore:
+    """
+    Players of a lobby by id, in display (join) order, indexed by group
+    and by btag so that lookups, moves, swaps and updates don't scan
+    the lobby. Records are the dicts sent to the browsers, they must
+    be changed through the store to keep the indices right.
+    """
+
+    groups = ("waiting", "red", "blue")
+
+    def __init__(self, players=()):
+        self._players: Dict[str, dict] = {}
+        self._groups: Dict[str, Set[str]] = { g: set() for g in self.groups }
+        self._tags: Dict[str, Set[str]] = {}
+        for player in players:
+            self.add(player)
+
+    def __len__(self):
+        return len(self._players)
+
+    def __iter__(self):
+        return iter(self._players.values())
+
+    def __contains__(self, playerId):
+        return playerId in self._players
+
+    def get(self, playerId) -> Optional[dict]:
+        return self._players.get(playerId)
+
+    def list(self) -> List[dict]:
+        return list(self._players.values())
+
+    def group(self, name) -> Set[str]:
+        """ Ids of the players in group `name` """
+        return self._groups.get(name, set())
+
+    def withTag(self, tag) -> List[dict]:
+        return [self._players[i] for i in self._tags.get(tag, ())]
+
+    def _index(self, player):
+        self._groups.setdefault(player["group"], set()).add(player["id"])
+        self._tags.setdefault(player["profileData"]["tag"], set()).add(player["id"])
 
-    def listen(self):
-        q = Queue(maxsize=10)
-        self._listeners.append(q)
-        return q
+    def _unindex(self, player):
+        self._groups[player["group"]].discard(player["id"])
+        tag = player["profileData"]["tag"]
+        self._tags[tag].discard(player["id"])
+        if not self._tags[tag]:
+            del self._tags[tag]
 
-    def broadcast(self, msg):
-        for i in reversed(range(len(self._listeners))):
-            try:
-                self._listeners[i].put_nowait(msg)
-            except:
-                del self._listeners[i]
+    def add(self, player) -> bool:
+        if player["id"] in self._players:
+            return False
+        self._players[player["id"]] = player
+        self._index(player)
+        return True
+
+    def remove(self, playerId) -> Optional[dict]:
+        player = self._players.pop(playerId, None)
+        if player is not None:
+            self._unindex(player)
+        return player
+
+    def move(self, playerId, group) -> bool:
+        player = self._players.get(playerId)
+        if player is None:
+            return False
+        self._groups[player["group"]].discard(playerId)
+        player["group"] = group
+        self._groups.setdefault(group, set()).add(playerId)
+        return True
+
+    def swap(self, playerId, targetId) -> bool:
+        player = self._players.get(playerId)
+        target = self._players.get(targetId)
+        if player is None or target is None:
+            return False
+        group = player["group"]
+        self.move(playerId, target["group"])
+        self.move(targetId, group)
+        return True
+
+    def update(self, playerId, change) -> Optional[dict]:
+        """ Apply `change(player)` to a player and reindex it """
+        player = self._players.get(playerId)
+        if player is None:
+            return None
+        self._unindex(player)
+        try:
+            change(player)
+        finally:
+            self._index(player)
+        return player
 
 
 class GameLobby:
+    # Events kept for browsers resuming their update stream
+    replaySize = int(os.environ.get('LOBBY_REPLAY_SIZE', 256))
+
     def __init__(self):
-        self.messageBus = MessageBus()
-        self.lobbyPlayers = None
+        self.messageBus = MessageBus(self.stateSync)
+        self.players = PlayerStore()
+        # Event ids are "<epoch>.<n>", the epoch tells a resuming browser
+        # apart from one that saw a previous instance of the lobby
+        self.epoch = uuid.uuid4().hex[:8]
+        self.eventCount = 0
+        self._history: Deque[Tuple[int, bytes]] = deque(maxlen=self.replaySize)
+        self._stateSync: Optional[Tuple[int, bytes]] = None
         
+    @property
+    def lobbyPlayers(self):
+        """ Players in display order, as rendered and synced to the browsers """
+        return self.players.list()
+
     async def lobbySetUp(self, debug=False):
-        self.lobbyPlayers = []
+        self.players = PlayerStore()
         if debug:
-            self.lobbyPlayers = [
+            feeniks, joshi, lio = await asyncio.gather(
+                getOverwatchProfile("Feeniks#21541"),
+                getOverwatchProfile("SuperJoshi94#2645"),
+                getOverwatchProfile("LioKioNio#2969"))
+            self.players = PlayerStore([
                     {   # Feeniks is high rank
                         "id": "dummy.0",
                         "title": "Feeniks",
                         "group": "waiting",
                         "selectedRoles": ["tank", "support"],
-                        "profileData": await getOverwatchProfile("Feeniks#21541"),
+                        "profileData": feeniks,
                     },
                     {   # Joshi has placed on all roles
                         "id": "dummy.1",
                         "title": "SuperJoshi94",
                         "group": "waiting",
                         "selectedRoles": ["damage"],
-                        "profileData": await getOverwatchProfile("SuperJoshi94#2645"),
+                        "profileData": joshi,
                     },
                     {   # Lio has placed on all roles but no public profile
                         "id": "dummy.2",
                         "title": "LioKioNio",
                         "group": "waiting",
                         "selectedRoles": ["tank"],
-                        "profileData": await getOverwatchProfile("LioKioNio#2969"),
+                        "profileData": lio,
                     },
-                ]
+                ])
+            for player in self.players:
+                refresher.watch(player["profileData"]["tag"], self)
 
     async def processMessage(self, msg):
         msg_type = msg["event"]
@@ -63,55 +282,107 @@ class GameLobby:
 
         # Can use a switch here
         if msg_type == "move-player":
-            self._movePlayer(msg_data["sourceID"], msg_data["targetGroup"])
+            if not self._movePlayer(msg_data["sourceID"], msg_data["targetGroup"]):
+                return False
             self._broadcast(msg)
             return True
 
         elif msg_type == "swap-player":
-            self._swapPlayer(msg_data["sourceID"], msg_data["targetID"])
+            if not self._swapPlayer(msg_data["sourceID"], msg_data["targetID"]):
+                return False
             self._broadcast(msg)
             return True
             
         elif msg_type == "update-player":
-            self._updatePlayerData(msg_data["playerID"], msg_data["updateData"])
+            if not self._updatePlayerData(msg_data["playerID"], msg_data["updateData"]):
+                return False
             self._broadcast(msg)
             return True
             
         elif msg_type == "refresh-player":
-            # Do it manually for now
-            
+            # The new profile is pushed with update-player once fetched
             player = self._findPlayer(msg_data["playerID"])
-            update = { "profileData": await getOverwatchProfile(player["profileData"]["tag"], force_update=True ) }
-
-            self._updatePlayerData(msg_data["playerID"], update)
-            self._broadcast({
-                    "event": "update-player",
-                    "data": { "playerID": player["id"], "updateData": update },
-                })
+            if player is None:
+                return False
+            refresher.schedule(Btag(player["profileData"]["tag"]), force=True)
             return True
 
         return False
 
-    def listenForUpdates(self):
-        return self.messageBus.listen()
+    @property
+    def lastEventId(self):
+        return "{}.{}".format(self.epoch, self.eventCount)
+
+    def listenForUpdates(self, lastEventId=None):
+        """ Subscribe to the updates, resuming after `lastEventId` if given """
+        backlog: List[bytes] = []
+        if lastEventId is not None:
+            backlog = self._eventsSince(lastEventId)
+        return self.messageBus.listen(backlog)
+
+    def _eventsSince(self, lastEventId) -> List[bytes]:
+        """ Events missed since `lastEventId`, or a state-sync if they are not all kept """
+        epoch, _, count = lastEventId.partition(".")
+        if epoch == self.epoch and count.isdigit():
+            seen = int(count)
+            if seen == self.eventCount:
+                return []
+            oldest = self._history[0][0] if self._history else self.eventCount + 1
+            if seen < self.eventCount and oldest <= seen + 1:
+                return [frame for eventId, frame in self._history if eventId > seen]
+        return [self.stateSync()]
+
+    def stateSync(self) -> bytes:
+        """ Whole lobby state, replacing what the browser has """
+        # Shared by the subscribers resyncing before the next event
+        if self._stateSync is None or self._stateSync[0] != self.eventCount:
+            frame = sseFrame({ "event": "state-sync",
+                               "data": { "players": self.lobbyPlayers } },
+                             self.lastEventId)
+            self._stateSync = (self.eventCount, frame)
+        return self._stateSync[1]
 
     def _broadcast(self, msg):
-        self.messageBus.broadcast(msg)
+        # Encoded once whatever the number of viewers
+        self.eventCount += 1
+        frame = sseFrame(msg, self.lastEventId)
+        self._history.append((self.eventCount, frame))
+        self.messageBus.broadcast(frame)
+
+    def profileRefreshed(self, tag, profileData):
+        """ Called by the refresher when fresh stats for `tag` arrive """
+        update = { "profileData": profileData }
+        for player in self.players.withTag(tag):
+            self.players.update(player["id"], lambda p: p.update(update))
+            self._broadcast({
+                    "event": "update-player",
+                    "data": { "playerID": player["id"], "updateData": update },
+                })
 
     async def playerJoin(self, playerId, bnetId: Btag, name=None):
         playerId = str(playerId) # kinda a hack to ensure all types are the same
         
         #Check if player already in lobby:
-        if self._findPlayer(playerId):
+        if playerId in self.players:
             self.playerLeave(playerId) #just remove for now
         
+        # Watched before fetching so that a stale profile is refreshed
+        # with the in-lobby priority
+        tag = Btag(bnetId).to_string()
+        refresher.watch(tag, self)
+        try:
+            profileData = await getOverwatchProfile(bnetId)
+        except Exception:
+            self._unwatchTag(tag)
+            raise
+
         # Create new lobby player
         playerData = {
             "id": playerId,
             "title": (name if name else playerId),
             "group": "waiting",
             "selectedRoles": ["tank", "damage", "support"],
-            "profileData": await getOverwatchProfile(bnetId),
+            "profileData": profileData,
         }
         if self._addPlayer(playerData):
             self._broadcast({
@@ -120,6 +391,7 @@ class GameLobby:
                 } )
             return True
         else:
+            self._unwatchTag(tag)
             return False
 
     def playerLeave(self, playerId):
@@ -134,64 +406,50 @@ class GameLobby:
         else:
             return False
 
-    def _findPlayer(self, playerId, index=False):
-        for i, player in enumerate(self.lobbyPlayers):
-            if player['id'] == playerId:
-                return i if index else player
-        else:
-            return None
-
-    # TODO add a true/false return for these functions
+    def _findPlayer(self, playerId):
+        return self.players.get(playerId)
 
     def _movePlayer(self, playerId, targetGroup):
-        self._findPlayer(playerId)['group'] = targetGroup
+        return self.players.move(playerId, targetGroup)
 
     def _swapPlayer(self, playerId, targetId):
-        player1 = self._findPlayer(playerId)
-        player2 = self._findPlayer(targetId)
-        player1group = player1['group']
-        player1['group'] = player2['group']
-        player2['group'] = player1group
+        return self.players.swap(playerId, targetId)
         
     def _updatePlayerData(self, playerId, playerData):
-        ind = self._findPlayer(playerId, True)
-        if not ind is None:
-            self.lobbyPlayers[ind].update(playerData)
-            return True
-        return False
+        return self.players.update(playerId, lambda p: p.update(playerData)) is not None
         
     def _updatePlayerValue(self, playerId, key, value):
-        player = self._findPlayer(playerId)
-        if not player is None:
+        def change(player):
             curr_item = player
             ks = key.split(".")
             for k in ks[:-1]:
-                itm = curr_item.get(k)
-                if not itm is None:
-                    curr_item = itm
-                else:
-                    curr_item[k] = {}
-                    curr_item = curr_item[k]
-            itm[ks[-1]] = value
-            return True
-        return False
+                curr_item = curr_item.setdefault(k, {})
+            curr_item[ks[-1]] = value
+        return self.players.update(playerId, change) is not None
            
     def _addPlayer(self, playerData):
-        if self._findPlayer(self, playerData["id"]) is None:
-            #TODO: Sanitise playerData
-            self.lobbyPlayers.append(playerData)
+        #TODO: Sanitise playerData
+        if self.players.add(playerData):
+            refresher.watch(playerData["profileData"]["tag"], self)
             return True
         else:
             return False
 
     def _removePlayer(self, playerId):
-        ind = self._findPlayer(playerId, True)
-        if ind is None:
+        player = self.players.remove(playerId)
+        if player is None:
             return False
         else:
-            _ = self.lobbyPlayers.pop(ind)
+            self._unwatch(player)
             return True
 
+    def _unwatch(self, player):
+        self._unwatchTag(player["profileData"]["tag"])
+
+    def _unwatchTag(self, tag):
+        if not self.players.withTag(tag):
+            refresher.unwatch(tag, self)
+
 def _getOverwatchProfile(bnetId):
     profile = {
         "tag": bnetId,
@@ -215,7 +473,11 @@ def _getOverwatchProfile(bnetId):
     }
     return profile
 
-careerDatabase = CareerDatabase()
+refresher = ProfileRefresher(careerDatabase)
 async def getOverwatchProfile(btag: Btag, force_update=False):
-    stats = await careerDatabase.getStats(Btag(btag), force_update)
-    return stats.__getFormattedHack__()
+    btag = Btag(btag)
+    stats = await careerDatabase.getStats(btag, force_update)
+    if not force_update and refresher.is_stale(stats):
+        # Serve what we have, fresh data is pushed once fetched
+        refresher.schedule(btag)
+    return stats.formatted()
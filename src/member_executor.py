@@ -0,0 +1,87 @@
+"""
+Run discord event handlers in order for each member,
+and concurrently for different members
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+import helper
+
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+class MemberExecutor:
+    """One queue of pending handlers per member, drained by its own task.
+    The number of pending handlers is bounded: once `max_backlog`
+    are waiting, submitting waits for a slot."""
+
+    def __init__(self, max_backlog: Optional[int] = None):
+        self.max_backlog = max_backlog or int(os.environ.get('EVENT_MAX_BACKLOG', 1000))
+        self.logger = helper.default_logger("MemberExecutor", logging.INFO)
+        self._queues: Dict[Hashable, Deque[Tuple[Handler, tuple, float]]] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.backlog = 0
+        self.handled = 0
+        self.failed = 0
+        self.throttled = 0
+        self._wait_total = 0.0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    async def submit(self, key: Hashable, handler: Handler, *args):
+        """Queue `handler(*args)` after the pending handlers of `key`"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_backlog)
+        if self._slots.locked():
+            self.throttled += 1
+            self.logger.warning("Event backlog full (%d), waiting", self.backlog)
+        await self._slots.acquire()
+        self.backlog += 1
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = deque()
+            self._queues[key] = queue
+            asyncio.ensure_future(self._drain(key, queue))
+        queue.append((handler, args, time.monotonic()))
+
+    async def _drain(self, key: Hashable, queue: Deque[Tuple[Handler, tuple, float]]):
+        assert self._slots
+        while queue:
+            handler, args, queued_at = queue.popleft()
+            start = time.monotonic()
+            try:
+                await handler(*args)
+            except Exception:
+                self.failed += 1
+                self.logger.exception("Handler %s failed for %s",
+                                      getattr(handler, "__name__", handler), key)
+            finally:
+                end = time.monotonic()
+                self.handled += 1
+                self._wait_total += start - queued_at
+                self._latency_total += end - start
+                self._latency_max = max(self._latency_max, end - start)
+                self.backlog -= 1
+                self._slots.release()
+        del self._queues[key]
+
+    def is_busy(self, key: Hashable) -> bool:
+        """Whether `key` has handlers pending or running"""
+        return key in self._queues
+
+    def stats(self) -> Dict[str, Any]:
+        handled = max(self.handled, 1)
+        return {"backlog": self.backlog,
+                "members": len(self._queues),
+                "handled": self.handled,
+                "failed": self.failed,
+                "throttled": self.throttled,
+                "avgWaitMs": round(self._wait_total / handled * 1000, 2),
+                "avgLatencyMs": round(self._latency_total / handled * 1000, 2),
+                "maxLatencyMs": round(self._latency_max * 1000, 2)}
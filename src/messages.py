@@ -1,5 +1,6 @@
 """Define messages between bot and backend"""
 
+import time
 from typing import Optional
 from collections import OrderedDict
 from btag import Btag
@@ -19,6 +20,7 @@ class PlayerJoined:
         self.server_id = server_id
         self.lobby_name = lobby_name
         self.nick = nick
+        self.sent_at = time.time()
 
 
 class PlayerLeft:
@@ -27,3 +29,4 @@ class PlayerLeft:
         self.player = player
         self.server_id = server_id
         self.lobby_name = lobby_name
+        self.sent_at = time.time()
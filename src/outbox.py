@@ -0,0 +1,212 @@
+"""
+Scheduler for the messages, edits and reactions the bot sends to discord
+"""
+
+import os
+import asyncio
+import itertools
+import logging
+from typing import Any, Callable, Awaitable, Deque, Dict, Hashable, Optional, Tuple, Union
+from collections import deque
+
+import discord
+
+import helper
+from ratelimit import TokenBucket
+
+
+class _Operation:
+    def __init__(self, route: Hashable, priority: int,
+                 call: Callable[[], Awaitable[Any]]):
+        self.route = route
+        self.priority = priority
+        self.call = call
+        self.future: asyncio.Future = asyncio.get_event_loop().create_future()
+
+
+class _Route:
+    """Operations sharing a discord rate limit bucket, run one at a time"""
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.operations: Deque[_Operation] = deque()
+        self.busy = False
+
+
+class DiscordOutbox:
+    """
+    Queue every outgoing discord call, grouped by rate limit route
+    (kind of call and channel). A route runs its operations in order,
+    no faster than its bucket allows; routes are served by priority.
+    Pending edits of a message are merged, only the latest is sent.
+    Operations return futures resolved with the call result, or None
+    if it failed.
+    """
+
+    # Lower is more urgent
+    PRIORITY_REGISTRATION = 0  # asking a player for their btag
+    PRIORITY_REPLY = 1         # answers to DMs and commands
+    PRIORITY_REACTION = 2      # reaction buttons
+    PRIORITY_EDIT = 3          # cosmetic edits
+    _priority_names = {PRIORITY_REGISTRATION: "registration",
+                       PRIORITY_REPLY: "reply",
+                       PRIORITY_REACTION: "reaction",
+                       PRIORITY_EDIT: "edit"}
+
+    # (rate per second, burst) of discord's per channel buckets
+    _limits = {"send": (1.0, 5), "edit": (1.0, 5), "reaction": (4.0, 1)}
+
+    def __init__(self, max_concurrency: Optional[int] = None):
+        env = os.environ.get
+        self.max_concurrency = max_concurrency or int(env('DISCORD_MAX_CONCURRENCY', 10))
+        self.logger = helper.default_logger("Outbox", logging.INFO)
+        self._global = TokenBucket(float(env('DISCORD_GLOBAL_RATE', 45)),
+                                   float(env('DISCORD_GLOBAL_RATE', 45)))
+        self._routes: Dict[Hashable, _Route] = {}
+        self._edits: Dict[int, Tuple[_Operation, list]] = {}
+        self._order = itertools.count()
+        self._ready: Optional[asyncio.PriorityQueue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._backlog: Dict[int, int] = {p: 0 for p in self._priority_names}
+        self.sent = 0
+        self.failed = 0
+        self.merged = 0
+
+    def _start(self):
+        if self._ready is None:
+            self._ready = asyncio.PriorityQueue()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            asyncio.ensure_future(self._dispatch())
+
+    def _route(self, key: Tuple[str, int]) -> _Route:
+        route = self._routes.get(key)
+        if route is None:
+            rate, burst = self._limits[key[0]]
+            route = _Route(TokenBucket(rate, burst))
+            self._routes[key] = route
+        return route
+
+    def _submit(self, key: Tuple[str, int], priority: int,
+                call: Callable[[], Awaitable[Any]]) -> _Operation:
+        self._start()
+        operation = _Operation(key, priority, call)
+        route = self._route(key)
+        route.operations.append(operation)
+        self._backlog[priority] += 1
+        if not route.busy and len(route.operations) == 1:
+            self._schedule(key, route)
+        return operation
+
+    def _schedule(self, key: Hashable, route: _Route):
+        assert self._ready
+        route.busy = True
+        head = route.operations[0]
+        self._ready.put_nowait((head.priority, next(self._order), key))
+
+    async def _dispatch(self):
+        assert self._ready and self._slots
+        loop = asyncio.get_event_loop()
+        while True:
+            priority, order, key = await self._ready.get()
+            route = self._routes[key]
+            delay = route.bucket.delay()
+            if delay > 0:
+                # Keep its place in the queue once its bucket has refilled
+                loop.call_later(delay, self._ready.put_nowait, (priority, order, key))
+                continue
+            await self._slots.acquire()
+            await self._global.acquire()
+            route.bucket.try_acquire()
+            operation = route.operations.popleft()
+            self._backlog[operation.priority] -= 1
+            asyncio.ensure_future(self._run(key, route, operation))
+
+    async def _run(self, key: Hashable, route: _Route, operation: _Operation):
+        assert self._slots
+        result = None
+        try:
+            result = await operation.call()
+            self.sent += 1
+        except discord.HTTPException as err:
+            self.failed += 1
+            self.logger.warning("%s failed: %s", key, err)
+        except Exception:
+            # e.g. a timeout or a network error, the caller still gets None
+            self.failed += 1
+            self.logger.exception("%s failed", key)
+        finally:
+            self._slots.release()
+            route.busy = False
+            if route.operations:
+                self._schedule(key, route)
+            if not operation.future.done():
+                operation.future.set_result(result)
+
+    def send(self, channel: discord.abc.Messageable, content: str,
+             priority: int = PRIORITY_REPLY) -> asyncio.Future:
+        """Send a message in a channel"""
+        key = ("send", getattr(channel, "id", id(channel)))
+        return self._submit(key, priority, lambda: channel.send(content)).future
+
+    def send_dm(self, user: Union[discord.Member, discord.User], content: str,
+                priority: int = PRIORITY_REGISTRATION) -> asyncio.Future:
+        """Send a DM to a user, opening the DM channel if needed"""
+        # Queued on the route of the DM channel, with the replies sent in it
+        if user.dm_channel is not None:
+            return self.send(user.dm_channel, content, priority)
+        future = asyncio.get_event_loop().create_future()
+        asyncio.ensure_future(self._open_dm(user, content, priority, future))
+        return future
+
+    async def _open_dm(self, user: Union[discord.Member, discord.User], content: str,
+                       priority: int, future: asyncio.Future):
+        result = None
+        try:
+            channel = await user.create_dm()
+            result = await self.send(channel, content, priority)
+        except discord.HTTPException as err:
+            self.failed += 1
+            self.logger.warning("Opening a DM with %s failed: %s", user.id, err)
+        except Exception:
+            self.failed += 1
+            self.logger.exception("Opening a DM with %s failed", user.id)
+        finally:
+            if not future.done():
+                future.set_result(result)
+
+    def edit(self, message: discord.Message, content: str) -> asyncio.Future:
+        """Edit a message, replacing any edit of it not sent yet"""
+        pending = self._edits.get(message.id)
+        if pending is not None:
+            self.merged += 1
+            pending[1][0] = content
+            return pending[0].future
+        latest = [content]
+
+        async def call():
+            del self._edits[message.id]
+            await message.edit(content=latest[0])
+            return message
+        operation = self._submit(("edit", message.channel.id),
+                                 self.PRIORITY_EDIT, call)
+        self._edits[message.id] = (operation, latest)
+        return operation.future
+
+    def add_reaction(self, message: discord.Message, emoji: str) -> asyncio.Future:
+        return self._submit(("reaction", message.channel.id),
+                            self.PRIORITY_REACTION,
+                            lambda: message.add_reaction(emoji)).future
+
+    def clear_reactions(self, message: discord.Message) -> asyncio.Future:
+        # Same route as add_reaction so that they stay in order
+        return self._submit(("reaction", message.channel.id),
+                            self.PRIORITY_REACTION,
+                            message.clear_reactions).future
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backlog": {name: self._backlog[p]
+                            for p, name in self._priority_names.items()},
+                "routes": len(self._routes),
+                "sent": self.sent,
+                "failed": self.failed,
+                "mergedEdits": self.merged}
+
@@ -0,0 +1,217 @@
+"""
+Shared asynchronous client for ow-api.com
+
+Every request goes through a single aiohttp session so that
+connections are kept alive and pooled. Requests are queued by
+priority and sent at the rate allowed by a token bucket; throttled
+or failed requests are retried with a jittered backoff.
+"""
+
+import os
+import json
+import asyncio
+import itertools
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+
+import helper
+from ratelimit import TokenBucket, backoff
+
+
+@dataclass
+class _Request:
+    btag: object
+    endpoint: str
+    priority: int
+    future: asyncio.Future
+    attempt: int = field(default=0)
+
+
+class OwApiClient:
+    """Pooled, rate limited, non-blocking HTTP client for the ow-api endpoints"""
+
+    _apiroot = "https://ow-api.com/v1/stats/pc/EU"
+
+    #TODO: Proper header
+    _hdr = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like Gecko) Chrome/23.0.1271.64 Safari/537.11',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3',
+            'Accept-Language': 'en-US,en;q=0.8'}
+
+    # Lower is served first
+    PRIORITY_VALIDATION = 0   # btag sent by DM, someone is waiting
+    PRIORITY_JOIN = 1         # profile of a player joining a lobby
+    PRIORITY_REFRESH = 2      # background refresh
+    _priority_names = {PRIORITY_VALIDATION: "validation",
+                       PRIORITY_JOIN: "join",
+                       PRIORITY_REFRESH: "refresh"}
+
+    def __init__(self,
+                 max_connections: Optional[int] = None,
+                 max_concurrency: Optional[int] = None,
+                 timeout: Optional[float] = None,
+                 rate: Optional[float] = None,
+                 burst: Optional[float] = None):
+        env = os.environ.get
+        self._apiroot = env('OWAPI_ROOT', self._apiroot)
+        self.max_connections = max_connections or int(env('OWAPI_MAX_CONNECTIONS', 20))
+        self.max_concurrency = max_concurrency or int(env('OWAPI_MAX_CONCURRENCY', 10))
+        self.timeout = timeout or float(env('OWAPI_TIMEOUT', 10))
+        self.max_retries = int(env('OWAPI_MAX_RETRIES', 3))
+        self.backoff = float(env('OWAPI_BACKOFF', 1))
+        self.logger = helper.default_logger("OwApi", logging.INFO)
+        self._bucket = TokenBucket(rate or float(env('OWAPI_RATE', 5)),
+                                   burst or float(env('OWAPI_BURST', 10)))
+        # All of these are bound to the running loop, so they're created lazily
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._dispatcher: Optional[asyncio.Future] = None
+        self._order = itertools.count()
+        self._depth: Dict[int, int] = {p: 0 for p in self._priority_names}
+        self.inflight = 0
+        self.sent = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                             keepalive_timeout=30)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self._hdr,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def _start(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._queue = asyncio.PriorityQueue()
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    def url(self, btag, endpoint: str) -> str:
+        """URL of `endpoint` (profile or complete) for a btag"""
+        return "{}/{}/{}".format(self._apiroot, btag.for_api(), endpoint)
+
+    async def fetch(self, btag, endpoint: str = "complete",
+                    priority: int = PRIORITY_JOIN) -> Optional[dict]:
+        """
+        Query `endpoint` for a btag, return the decoded JSON
+        or None if the player couldn't be fetched
+        """
+        _, data = await self.fetch_status(btag, endpoint, priority)
+        return data
+
+    async def fetch_status(self, btag, endpoint: str = "complete",
+                           priority: int = PRIORITY_JOIN) -> Tuple[Optional[int], Optional[dict]]:
+        """
+        Like fetch, also returning the HTTP status of the last attempt
+        (None if ow-api couldn't be reached)
+        """
+        self._start()
+        future = asyncio.get_event_loop().create_future()
+        self._enqueue(_Request(btag, endpoint, priority, future))
+        return await future
+
+    @staticmethod
+    def is_transient(status: Optional[int], data: Optional[dict]) -> bool:
+        """Whether a failed fetch may succeed later (network, throttling, garbage)"""
+        return status is None or status == 429 or status >= 500 or (status == 200 and data is None)
+
+    def _enqueue(self, request: _Request):
+        assert self._queue
+        self._depth[request.priority] += 1
+        self._queue.put_nowait((request.priority, next(self._order), request))
+
+    async def _dispatch(self):
+        assert self._queue and self._semaphore
+        while True:
+            _, _, request = await self._queue.get()
+            self._depth[request.priority] -= 1
+            if request.future.done():
+                # Caller gave up while it was queued
+                continue
+            await self._semaphore.acquire()
+            await self._bucket.acquire()
+            asyncio.ensure_future(self._send(request))
+
+    async def _send(self, request: _Request):
+        try:
+            await self._attempt(request)
+        except Exception as err:
+            self.failed += 1
+            self.logger.exception("Request for %s failed", request.btag)
+            if not request.future.done():
+                request.future.set_exception(err)
+
+    async def _attempt(self, request: _Request):
+        assert self._semaphore
+        self.inflight += 1
+        try:
+            status, data, retry_after = await self._get(request)
+        finally:
+            self.inflight -= 1
+            self._semaphore.release()
+        self.sent += 1
+        if self.is_transient(status, data) and request.attempt < self.max_retries:
+            request.attempt += 1
+            self.retries += 1
+            delay = retry_after or backoff(request.attempt, self.backoff)
+            if status == 429:
+                # Everybody slows down, not only this request
+                self.throttled += 1
+                self._bucket.block(delay)
+            self.logger.debug("Retrying %s in %.1fs (HTTP %s)",
+                              request.btag, delay, status)
+            asyncio.get_event_loop().call_later(delay, self._enqueue, request)
+            return
+        if status != 200 or data is None:
+            self.failed += 1
+            self.logger.debug("%s: HTTP %s", request.btag, status)
+        if not request.future.done():
+            request.future.set_result((status, data))
+
+    async def _get(self, request: _Request) -> Tuple[Optional[int], Optional[dict], Optional[float]]:
+        """Send the request, return its status, content and Retry-After"""
+        session = self._get_session()
+        try:
+            async with session.get(self.url(request.btag, request.endpoint)) as response:
+                if response.status != 200:
+                    retry_after = response.headers.get('Retry-After', '')
+                    return (response.status, None,
+                            float(retry_after) if retry_after.isdigit() else None)
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            self.logger.warning("Could not fetch %s: %r", request.btag, err)
+            return None, None, None
+        try:
+            return 200, json.loads(body.decode('utf-8')), None
+        except (ValueError, UnicodeDecodeError):
+            # e.g. an HTML error page from a proxy
+            self.logger.warning("Invalid JSON for %s: %r", request.btag, body[:100])
+            return 200, None, None
+
+    def stats(self) -> Dict[str, object]:
+        return {"queued": {name: self._depth[p]
+                           for p, name in self._priority_names.items()},
+                "inflight": self.inflight,
+                "sent": self.sent,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "failed": self.failed}
+
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+client = OwApiClient()
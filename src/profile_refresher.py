@@ -0,0 +1,149 @@
+"""
+Background refresh of career profiles
+
+Profiles are served from the database straight away; the ones older
+than PROFILE_MAX_AGE are queued here and refreshed by a few workers.
+Lobbies watching a btag are told when fresh data arrives.
+"""
+
+import os
+import asyncio
+import itertools
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+import helper
+from btag import Btag
+from owapi import OwApiClient
+
+
+class ProfileRefresher:
+    """Priority queue of profiles to refresh, drained by background workers"""
+
+    # Lower is more urgent
+    PRIORITY_FORCED = 0       # refresh-player from the web lobby
+    PRIORITY_IN_LOBBY = 1     # player currently shown in a lobby
+    PRIORITY_BACKGROUND = 2
+
+    def __init__(self, database, max_age: Optional[float] = None,
+                 workers: Optional[int] = None,
+                 sweep_interval: Optional[float] = None):
+        env = os.environ.get
+        self._database = database
+        self.max_age = timedelta(seconds=max_age or float(env('PROFILE_MAX_AGE', 3600)))
+        self.workers = workers or int(env('PROFILE_REFRESH_WORKERS', 2))
+        self.sweep_interval = sweep_interval or float(env('PROFILE_SWEEP_INTERVAL', 300))
+        self.logger = helper.default_logger("ProfileRefresher", logging.INFO)
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._order = itertools.count()
+        # btag -> most urgent priority it is queued with
+        self._queued: Dict[str, int] = {}
+        self._forced: Set[str] = set()
+        # btag -> lobbies showing it, and date of the last data seen for it
+        self._watchers: Dict[str, Set] = {}
+        self._taken_at: Dict[str, Optional[datetime]] = {}
+        self.refreshed = 0
+        self.failed = 0
+
+    def _start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.ensure_future(self._worker())
+                       for _ in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._sweep()))
+
+    def watch(self, tag: str, lobby):
+        """Notify `lobby` (via profileRefreshed) when `tag` is refreshed"""
+        self._watchers.setdefault(tag, set()).add(lobby)
+        self._taken_at.setdefault(tag, None)
+
+    def unwatch(self, tag: str, lobby):
+        lobbies = self._watchers.get(tag)
+        if lobbies is None:
+            return
+        lobbies.discard(lobby)
+        if not lobbies:
+            del self._watchers[tag]
+            del self._taken_at[tag]
+
+    def is_stale(self, profile) -> bool:
+        taken_at = profile.taken_at
+        return taken_at is None or datetime.now() - taken_at > self.max_age
+
+    def schedule(self, btag: Btag, force: bool = False):
+        """Queue a refresh of `btag` unless one at least as urgent is queued"""
+        self._start()
+        assert self._queue
+        tag = btag.to_string()
+        if force:
+            priority = self.PRIORITY_FORCED
+            self._forced.add(tag)
+        elif tag in self._watchers:
+            priority = self.PRIORITY_IN_LOBBY
+        else:
+            priority = self.PRIORITY_BACKGROUND
+        if self._queued.get(tag, priority + 1) <= priority:
+            return
+        self._queued[tag] = priority
+        self._queue.put_nowait((priority, next(self._order), tag))
+
+    async def _sweep(self):
+        """Periodically queue the stale profiles shown in lobbies"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            now = datetime.now()
+            for tag, taken_at in list(self._taken_at.items()):
+                if taken_at is None or now - taken_at > self.max_age:
+                    self.schedule(Btag(tag))
+
+    async def _worker(self):
+        assert self._queue
+        while True:
+            priority, _, tag = await self._queue.get()
+            # Entry superseded by a more urgent one already processed
+            if self._queued.get(tag) != priority:
+                continue
+            del self._queued[tag]
+            force = tag in self._forced
+            self._forced.discard(tag)
+            try:
+                await self._refresh(tag, force)
+            except Exception:
+                self.failed += 1
+                self.logger.exception("Could not refresh %s", tag)
+
+    async def _refresh(self, tag: str, force: bool):
+        btag = Btag(tag)
+        if force:
+            # Someone is waiting on it, don't leave it behind the
+            # background refreshes upstream
+            stale = True
+            profile = await self._database.getStats(
+                btag, force_update=True, priority=OwApiClient.PRIORITY_JOIN)
+        else:
+            # Only queries upstream when neither cached nor on disk,
+            # which gives a fresh snapshot
+            profile = await self._database.getStats(
+                btag, priority=OwApiClient.PRIORITY_REFRESH)
+            stale = self.is_stale(profile)
+            if stale:
+                profile = await self._database.getStats(
+                    btag, force_update=True, priority=OwApiClient.PRIORITY_REFRESH)
+        if stale:
+            self.refreshed += 1
+        if tag in self._taken_at:
+            self._taken_at[tag] = profile.taken_at
+        if not stale:
+            # Lobbies already show this snapshot
+            return
+        for lobby in list(self._watchers.get(tag, ())):
+            lobby.profileRefreshed(tag, profile.formatted())
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": len(self._queued),
+                "watched": len(self._watchers),
+                "refreshed": self.refreshed,
+                "failed": self.failed}
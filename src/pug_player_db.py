@@ -2,11 +2,14 @@
 Define class handling player database for the bot
 """
 
+import asyncio
 import discord
-from typing import OrderedDict, Union, Optional
+from collections import OrderedDict as odict
+from typing import OrderedDict, Union, Optional, Dict, List, Set, Tuple
 from btag import Btag
 from bot import MyClient
-from messages import PlayerJoined
+from messages import PlayerJoined, PlayerLeft
+from registration_store import RegistrationStore
 
 class PUGPlayerStatus:
     """ Group info regarding a player status when they're in a VC"""
@@ -29,15 +32,27 @@ class PUGPlayerStatus:
 
 class PUGPlayerDB:
     """Helper class facilitating management of list of PUG players"""
-    def __init__(self, client: MyClient):
+    def __init__(self, client: MyClient,
+                 registrations: Optional[RegistrationStore] = None):
         self._client = client
         self._players: dict[int, PUGPlayerStatus] = {}
+        # btags of every player who ever registered, survives restarts
+        # Not `or`: an empty store is falsy
+        self.registrations = (registrations if registrations is not None
+                              else RegistrationStore())
+        self.registrations.subscribe(self._btags_changed)
+
+    def _known_btags(self, did: int) -> OrderedDict[Btag, bool]:
+        return odict((Btag(tag), True) for tag in self.registrations.get(did))
 
     def get(self, did: int) -> Optional[PUGPlayerStatus]:
         if did in self._players:
             return self._players[did]
         return None
 
+    def items(self):
+        return self._players.items()
+
     def is_registered(self, did: int) -> bool:
         player = self.get(did)
         if player:
@@ -54,13 +69,56 @@ class PUGPlayerDB:
     async def start_registration(self, member: discord.Member,
                                  channel: discord.VoiceChannel,
                                  btags: OrderedDict[Btag, bool]):
-        self._players[member.id] = PUGPlayerStatus(member, channel, btags)
-        await self._client.send_registration_dm(member)
+        known = self._known_btags(member.id)
+        known.update(btags)
+        self._players[member.id] = PUGPlayerStatus(member, channel, known)
+        if known:
+            # Registered before, no need to ask again
+            await self.register(member.id)
+        else:
+            await self._client.send_registration_dm(member)
 
     async def add_btag(self, did: int, btag: Btag):
         player = self.get(did)
         assert(player)
         player.add_btag(btag)
+        self.registrations.put(did, [tag.to_string() for tag in player.btags])
+
+    def remember_btag(self, did: int, btag: Btag):
+        """Add the btag of a player not in any of our lobbies"""
+        tags = [tag for tag in self.registrations.get(did) if tag != btag.to_string()]
+        self.registrations.put(did, tags + [btag.to_string()])
+
+    def _btags_changed(self, did: int, btags: List[str]):
+        """Btags given to the process receiving the DMs"""
+        player = self.get(did)
+        if player is None or not btags:
+            return
+        player.btags = odict((Btag(tag), True) for tag in btags)
+        if not player.is_registered and player.channel is not None:
+            asyncio.ensure_future(
+                self._client._events.submit(did, self._register_pending, did))
+
+    async def _register_pending(self, did: int):
+        player = self.get(did)
+        if player is not None and not player.is_registered and player.channel is not None:
+            await self.register(did)
+
+    def _joined(self, player: PUGPlayerStatus) -> PlayerJoined:
+        assert(player.channel)
+        server_id = player.channel.guild.id
+        lobby_name = self._client._get_pugs_lobby(player.channel).name
+        return PlayerJoined("{}".format(player.member.id),
+                            player.btags,
+                            server_id,
+                            lobby_name,
+                            nick=player.member.display_name)
+
+    def joined_messages(self) -> List[PlayerJoined]:
+        """Joins of every registered player currently in a PUG lobby"""
+        return [self._joined(player) for player in self._players.values()
+                if player.is_registered and player.channel is not None
+                and self._client._get_pugs_lobby(player.channel) is not None]
 
     async def register(self, did: int,
                        channel: Optional[discord.VoiceChannel]=None):
@@ -69,11 +127,52 @@ class PUGPlayerDB:
         if channel:
             player.channel = channel
         assert(player.channel)
-        server_id = player.channel.guild.id
-        lobby_name = self._client._get_pugs_lobby(player.channel).name
-        await self._client.ref.put(PlayerJoined("{}".format(player.member.id),
-                                                player.btags,
-                                                server_id,
-                                                lobby_name,
-                                                nick=player.member.display_name))
+        await self._client.ref.put(self._joined(player))
         player.is_registered = True
+
+    async def reconcile(self,
+                        present: Dict[int, Tuple[discord.Member, discord.VoiceChannel]],
+                        skip: Set[int] = set()
+                        ) -> List[Union[PlayerJoined, PlayerLeft]]:
+        """
+        Bring the players in line with who is actually in a PUG lobby
+        (`present`: discord id -> (member, lobby VC)), leaving out `skip`:
+        - players gone from their lobby leave it
+        - players we know the btags of join their lobby
+        - unknown players are asked for their btag
+        Return the messages to send to the backend.
+        """
+        messages: List[Union[PlayerJoined, PlayerLeft]] = []
+        for did, player in self._players.items():
+            if player.channel is None or did in skip:
+                continue
+            current = present.get(did)
+            if current is not None and current[1].id == player.channel.id:
+                continue
+            if player.is_registered:
+                lobby = self._client._get_pugs_lobby(player.channel)
+                if lobby is not None:
+                    messages.append(PlayerLeft("{}".format(did),
+                                               player.channel.guild.id,
+                                               lobby.name))
+            player.leave_channel()
+
+        for did, (member, channel) in present.items():
+            status = self.get(did)
+            if status is None:
+                known = self._known_btags(did)
+                if not known:
+                    await self.start_registration(member, channel, odict())
+                    continue
+                status = PUGPlayerStatus(member, channel, known)
+                self._players[did] = status
+                messages.append(self._joined(status))
+                status.is_registered = True
+            elif status.channel is None:
+                status.member = member
+                status.channel = channel
+                # Players who haven't given their btag yet were already asked
+                if status.btags:
+                    messages.append(self._joined(status))
+                    status.is_registered = True
+        return messages
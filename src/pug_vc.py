@@ -3,7 +3,7 @@ Wrapper around discord voice channel to add
 PUG-related information
 """
 
-from typing import Union, Dict, Optional
+from typing import Union, Dict, Optional, Set
 from dataclasses import dataclass
 import discord
 from guildconf import GuildConfig
@@ -30,22 +30,68 @@ class Other():
     voice_chan: Optional[discord.VoiceChannel]
 
 
-def make_vc_wrapper(config: Dict[str, GuildConfig],
+@dataclass(frozen=True)
+class ChannelEntry():
+    """Where a voice channel sits in the PUG config"""
+    guild_id: int
+    lobby_name: str
+    role: str
+    lobby: int
+
+
+class ChannelIndex():
+    """Map the id of every PUG voice channel to its lobby,
+    kept up to date guild by guild"""
+
+    LOBBY = "lobby"
+    TEAM1 = "team1"
+    TEAM2 = "team2"
+
+    def __init__(self, config: Optional[Dict[int, GuildConfig]] = None):
+        self._channels: Dict[int, ChannelEntry] = {}
+        self.by_guild: Dict[int, Set[int]] = {}
+        for guild in (config or {}).values():
+            self.update_guild(guild)
+
+    def update_guild(self, guild: GuildConfig):
+        """(Re)index the lobbies of a guild"""
+        self.remove_guild(guild.guild_id)
+        channels = set()
+        for name, lobby in guild.lobbies.items():
+            for role, chan in ((self.LOBBY, lobby.lobby),
+                               (self.TEAM1, lobby.team1),
+                               (self.TEAM2, lobby.team2)):
+                self._channels[chan] = ChannelEntry(guild.guild_id, name,
+                                                    role, lobby.lobby)
+                channels.add(chan)
+        self.by_guild[guild.guild_id] = channels
+
+    def remove_guild(self, guild_id: int):
+        for chan in self.by_guild.pop(guild_id, ()):
+            del self._channels[chan]
+
+    def get(self, channel_id: int) -> Optional[ChannelEntry]:
+        return self._channels.get(channel_id)
+
+    def lobby_channel(self, channel_id: int) -> Optional[int]:
+        """Lobby VC of the PUG lobby a channel belongs to"""
+        entry = self._channels.get(channel_id)
+        return entry.lobby if entry else None
+
+
+def make_vc_wrapper(index: ChannelIndex,
                     vchan: Optional[discord.VoiceChannel]) -> Union[Lobby,
                                                                     Team,
                                                                     Other]:
     """Make a wrapper from "raw" discord VC"""
     if not vchan:
         return Other(vchan)
-    for guild in config.values():
-        for name, lobby in guild.lobbies.items():
-            if vchan.id == lobby.lobby:
-                return Lobby(vchan, name)
-            if vchan.id == lobby.team1:
-                return Team(vchan, name)
-            if vchan.id == lobby.team2:
-                return Team(vchan, name)
-    return Other(vchan)
+    entry = index.get(vchan.id)
+    if entry is None:
+        return Other(vchan)
+    if entry.role == ChannelIndex.LOBBY:
+        return Lobby(vchan, entry.lobby_name)
+    return Team(vchan, entry.lobby_name)
 
 
 def is_same_lobby(vchan1: Union[Lobby, Team, Other],
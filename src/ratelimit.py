@@ -0,0 +1,55 @@
+"""
+Rate limiting helpers
+"""
+
+import time
+import random
+import asyncio
+from typing import Callable
+
+
+class TokenBucket:
+    """Allow `rate` operations per second, with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._last = clock()
+        self._blocked_until = 0.0
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self) -> float:
+        """Seconds to wait before a token is available"""
+        self._refill()
+        blocked = self._blocked_until - self._clock()
+        if self._tokens >= 1:
+            return max(0.0, blocked)
+        return max(blocked, (1 - self._tokens) / self.rate)
+
+    def try_acquire(self) -> bool:
+        if self.delay() > 0:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+
+    def block(self, seconds: float):
+        """Hand out no token for `seconds`, e.g. when told to slow down"""
+        self._blocked_until = max(self._blocked_until, self._clock() + seconds)
+
+
+def backoff(attempt: int, base: float, cap: float = 60.0) -> float:
+    """Exponential backoff with jitter for the `attempt`-th retry (from 1)"""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
@@ -0,0 +1,228 @@
+"""
+Persistent store of the btags registered by each discord user
+"""
+
+import os
+import json
+import fcntl
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import helper
+from ratelimit import backoff
+
+
+Listener = Callable[[int, List[str]], None]
+
+
+class RegistrationStore:
+    """
+    Discord id -> btags (oldest first), kept in memory and persisted
+    in an append-only journal: every change appends the full btag list
+    of one user. Appends are done off the event loop, and the journal
+    is rewritten with one line per user once it grows `compact_ratio`
+    times bigger than that.
+    A single process writes the journal, holding a lock on it; the
+    others are given `writer=False` and `follow` it, reading the lines
+    it appends every `poll_interval` seconds.
+    """
+
+    def __init__(self, path: Optional[str] = None,
+                 compact_ratio: int = 4, compact_min: int = 1000,
+                 flush_delay: float = 0.5, writer: bool = True,
+                 poll_interval: Optional[float] = None):
+        root = os.environ.get('DATABASE_ROOT', ".")
+        self.path = path or os.path.join(root, "registrations.journal")
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.flush_delay = flush_delay
+        self.writer = writer
+        self.poll_interval = poll_interval or float(os.environ.get('REGISTRATIONS_POLL', 1.0))
+        self.logger = helper.default_logger("RegistrationStore", logging.INFO)
+        self._btags: Dict[int, List[str]] = {}
+        self._listeners: List[Listener] = []
+        self._records = 0
+        # Journal read so far, by the processes following it
+        self._inode: Optional[int] = None
+        self._offset = 0
+        self._lock = self._take_lock() if writer else None
+        self._pending: List[str] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Flushes failed in a row
+        self._failures = 0
+        # Journal writes are done in order by a single thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._load()
+
+    def _take_lock(self):
+        lock = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            raise RuntimeError("{} is already written by another process".format(self.path))
+        return lock
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+" if self.writer else "rb") as journal:
+            self._inode = os.fstat(journal.fileno()).st_ino
+            content = journal.read()
+            end = content.rfind(b"\n") + 1
+            if end < len(content) and self.writer:
+                # Last line partly written by a crash, drop it so that
+                # the next append doesn't end up glued to it
+                self.logger.warning("Truncating %d bytes of torn journal line",
+                                    len(content) - end)
+                journal.truncate(end)
+        # A follower reads a line still being appended once it's complete
+        self._offset = end
+        self._read(content[:end])
+        self.logger.info("Loaded %d registrations", len(self._btags))
+
+    def _read(self, content: bytes) -> Set[int]:
+        """Apply journal lines, return the users whose btags changed"""
+        changed = set()
+        for line in content.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                self.logger.warning("Skipping corrupt journal line")
+                continue
+            did = int(record["d"])
+            if self._btags.get(did, []) != record["b"]:
+                changed.add(did)
+            self._apply(did, record["b"])
+            self._records += 1
+        return changed
+
+    def _apply(self, did: int, btags: List[str]):
+        if btags:
+            self._btags[did] = btags
+        else:
+            self._btags.pop(did, None)
+
+    def subscribe(self, listener: Listener):
+        """Call `listener` with the users whose btags the writer changed"""
+        self._listeners.append(listener)
+
+    def get(self, did: int) -> List[str]:
+        return list(self._btags.get(did, []))
+
+    def __contains__(self, did: int) -> bool:
+        return did in self._btags
+
+    def __len__(self) -> int:
+        return len(self._btags)
+
+    def put(self, did: int, btags: List[str]):
+        """Set the btags of a user, an empty list forgets them"""
+        assert self.writer, "registrations are only written by the process running shard 0"
+        if self._btags.get(did, []) == btags:
+            return
+        self._apply(did, list(btags))
+        self._pending.append(json.dumps({"d": did, "b": btags}) + "\n")
+        if self._flush_handle is None:
+            self._schedule_flush(self.flush_delay)
+
+    def _schedule_flush(self, delay: float):
+        loop = asyncio.get_event_loop()
+        self._flush_handle = loop.call_later(
+            delay, lambda: asyncio.ensure_future(self.flush()))
+
+    def _append(self, lines: List[str]):
+        with open(self.path, "a+b") as journal:
+            # A failed append may have left a partial line, start a new one
+            if journal.tell() > 0:
+                journal.seek(journal.tell() - 1)
+                if journal.read(1) != b"\n":
+                    journal.write(b"\n")
+            journal.writelines(line.encode('utf-8') for line in lines)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _compact(self, lines: List[str]):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as journal:
+            journal.writelines(lines)
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp, self.path)
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        lines, self._pending = self._pending, []
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._append, lines)
+        except OSError:
+            self.logger.exception("Could not write %d registrations", len(lines))
+            self._pending = lines + self._pending
+            # Don't wait for the next change to try again
+            self._failures += 1
+            self._schedule_flush(backoff(self._failures, self.flush_delay))
+            return
+        self._failures = 0
+        self._records += len(lines)
+        if self._records > max(self.compact_min, self.compact_ratio * len(self._btags)):
+            await self.compact()
+
+    async def compact(self):
+        """Rewrite the journal with the current btags of each user"""
+        lines = [json.dumps({"d": did, "b": btags}) + "\n"
+                 for did, btags in self._btags.items()]
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self._executor, self._compact, lines)
+        self._records = len(lines)
+
+    def _read_new(self) -> Tuple[bool, bytes]:
+        """Lines appended since the last read, all of them if the journal was replaced"""
+        try:
+            journal = open(self.path, "rb")
+        except FileNotFoundError:
+            return False, b""
+        with journal:
+            stat = os.fstat(journal.fileno())
+            reset = stat.st_ino != self._inode or stat.st_size < self._offset
+            if reset:
+                self._inode, self._offset = stat.st_ino, 0
+            journal.seek(self._offset)
+            content = journal.read()
+        end = content.rfind(b"\n") + 1
+        self._offset += end
+        return reset, content[:end]
+
+    async def follow(self):
+        """Keep up with the journal written by another process"""
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                reset, content = await loop.run_in_executor(self._executor, self._read_new)
+            except OSError:
+                self.logger.exception("Could not read the registrations journal")
+                continue
+            if reset:
+                # Compacted by the writer
+                before, self._btags, self._records = self._btags, {}, 0
+                self._read(content)
+                changed = {did for did in set(before) | set(self._btags)
+                           if before.get(did) != self._btags.get(did)}
+            else:
+                changed = self._read(content)
+            for did in changed:
+                for listener in self._listeners:
+                    listener(did, self.get(did))
+
+    async def close(self):
+        await self.flush()
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
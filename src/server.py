@@ -6,9 +6,12 @@ import os
 import pkgutil
 import asyncio
 import messages
+import owapi
 
+import lobby as lobby_module
+from bridge import LobbyBridge
 from lobby import GameLobby
-from typing import Dict
+from typing import Callable, Dict, Optional
 
 import jinja2
 from quart import Quart
@@ -16,6 +19,8 @@ from quart import send_from_directory, Response, request, redirect
 
 
 app = Quart(__name__)
+# Seconds between keepalive comments on idle update streams
+SSE_KEEPALIVE = float(os.environ.get('SSE_KEEPALIVE', 15))
 lobby_ = GameLobby()
 lobbies: Dict[ int, Dict[ str, GameLobby ] ] =  {}
 templateLoader = jinja2.Environment(
@@ -74,7 +79,8 @@ async def render_lobby(server_id, lobby_name):
     if lobby is None:
         return ("No lobby here :(", 404)
         
-    return render_template('index.html', lobbyPlayers=lobby.lobbyPlayers)
+    return render_template('index.html', lobbyPlayers=lobby.lobbyPlayers,
+                           lastEventId=lobby.lastEventId)
     
     
 @app.route('/<int:server_id>/<lobby_name>/lobbyupdates', methods=['GET'])
@@ -84,13 +90,24 @@ async def broadcastLobbyUpdates(server_id, lobby_name):
     if lobby is None:
         return ("No lobby here :(", 404)
         
-    # Get a listener from the lobby
-    def stream():
-        listener = lobby.listenForUpdates()  # returns a queue.Queue
-        while True:
-            msg = listener.get()
-            msg = json.dumps(msg)
-            yield "data: {}\n\n".format(msg).encode('utf-8')
+    # Browsers resume from the id of the last event they got, or from
+    # the state the page was rendered with when first connecting
+    lastEventId = request.headers.get('Last-Event-ID') or request.args.get('since')
+
+    # Unsubscribed as soon as the browser goes away: quart closes the
+    # generator, exiting the with block
+    async def stream():
+        with lobby.listenForUpdates(lastEventId) as listener:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(listener.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Writing something is how a dead connection gets noticed
+                    yield b": keepalive\n\n"
+                    continue
+                if frame is None:
+                    return
+                yield frame
             
     response = Response(stream(), mimetype="text/event-stream")
     response.headers['Cache-Control'] = 'no-cache'
@@ -121,6 +138,25 @@ async def processLobbyUpdates(server_id, lobby_name):
 
 
 
+# Other components running in this process (e.g. the bot) register here
+stats_providers: Dict[ str, Callable[ [], dict ] ] = {}
+
+@app.route('/stats')
+async def print_stats():
+    stats = {
+        "profileCache": lobby_module.careerDatabase.cacheStats(),
+        "profileRefresh": lobby_module.refresher.stats(),
+        "owApi": owapi.client.stats(),
+        "updateStreams": {
+            "viewers": sum(len(lb.messageBus) for srv in lobbies.values() for lb in srv.values()),
+            "resyncs": sum(lb.messageBus.resyncs for srv in lobbies.values() for lb in srv.values()),
+        },
+    }
+    for name, provider in stats_providers.items():
+        stats[name] = provider()
+    return stats
+
+
 @app.route('/favicon.ico')
 async def favicon():
     return redirect('/assets/favicon.ico')
@@ -135,35 +171,45 @@ async def send_assets(path):
         return pkgutil.get_data(__name__, os.path.join("..", "assets", path))
 
         
+async def apply_message(message):
+    if isinstance(message, messages.PlayerJoined):
+        server_lobbies = lobbies.get(message.server_id, None)
+        if server_lobbies is None:
+            lobbies[message.server_id] = {}
+            server_lobbies = lobbies[message.server_id]
+        lobby = server_lobbies.get(message.lobby_name, None)
+        if lobby is None:
+            lobby = GameLobby()
+            await lobby.lobbySetUp()
+            lobbies[message.server_id][message.lobby_name] = lobby
+        await lobby.playerJoin(message.player, list(message.btags.keys())[-1].to_string(), name=message.nick)
+
+    if isinstance(message, messages.PlayerLeft):
+        lobby = get_lobby(message.server_id, message.lobby_name)
+        if lobby is not None:
+            lobby.playerLeave(message.player)
+
+
+bridge = LobbyBridge(apply_message)
+stats_providers["bridge"] = bridge.stats
+
+
 async def read_queue(queue: asyncio.Queue):
-    while True:
-        message = await queue.get()
-        if isinstance(message, messages.PlayerJoined):
-            server_lobbies = lobbies.get(message.server_id, None)
-            if server_lobbies is None:
-                lobbies[message.server_id] = {}
-                server_lobbies = lobbies[message.server_id]
-            lobby = server_lobbies.get(message.lobby_name, None)
-            if lobby is None:
-                lobby = GameLobby()
-                await lobby.lobbySetUp()
-                lobbies[message.server_id][message.lobby_name] = lobby
-            await lobby.playerJoin(message.player, list(message.btags.keys())[-1].to_string(), name=message.nick)
-            
-        if isinstance(message, messages.PlayerLeft):
-           lobby = get_lobby(message.server_id, message.lobby_name)
-           if server_lobbies is not None:
-                lobby.playerLeave(message.player)
-           
+    await bridge.run(queue)
+
 
 async def run(port, debug=False):
     await app.run_task(port=port, debug=debug)
 
-async def main(queue: asyncio.Queue, port=8080, debug=False):
+async def main(queue: Optional[asyncio.Queue], port=8080, debug=False):
+    """Serve the lobbies, updated from `queue` if given (read elsewhere otherwise)"""
     lobbies[0] = {}
     lobbies[0]["test"] = lobby_
     await lobby_.lobbySetUp(debug=True)
 
+    if queue is None:
+        await run(port, debug=debug)
+        return
     await asyncio.gather(
         run(port, debug=debug),
         read_queue(queue)
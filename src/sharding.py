@@ -0,0 +1,134 @@
+"""
+Route the messages of a sharded bot to one backend queue per shard
+
+A bot can be split between processes each running a range of shards
+(SHARD_COUNT=<n> with SHARD_IDS=<ids>). Such a process gets its own:
+- IPC socket: IPC_PATH with the range before the extension, e.g.
+  pugbot.shards-0-3.sock, the SERVER_ONLY processes feeding on its
+  lobbies set IPC_PATH to it
+- server port: SERVER_PORT + the first shard id of the range
+Discord sends every DM to shard 0, so the process running it is the
+only one writing the registrations journal (btags given in DMs, also
+for players in lobbies of other shards); the other processes follow
+it. Guild configs stay in the shared CONFIG_DB, a guild only being
+changed by the process running its shard.
+"""
+
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+import helper
+from bridge import make_queue
+from messages import PlayerJoined, PlayerLeft
+
+
+def shard_of(guild_id: int, shard_count: int) -> int:
+    """Shard discord sends the events of a guild to"""
+    return (guild_id >> 22) % shard_count
+
+
+def parse_shard_ids(spec: str) -> List[int]:
+    """Parse a list of shard ids like "0-3,8,10-11" """
+    ids: List[int] = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            ids.extend(range(int(first), int(last) + 1))
+        else:
+            ids.append(int(part))
+    return ids
+
+
+def shard_options() -> Optional[Dict[str, Any]]:
+    """
+    Sharding options of the client from the environment, None when not sharded:
+    SHARD_COUNT=auto lets discord pick the number of shards,
+    SHARD_COUNT=<n> with SHARD_IDS=<ids> runs some of the n shards
+    in this process, all of them if SHARD_IDS is not set
+    """
+    count = os.environ.get('SHARD_COUNT')
+    if not count:
+        return None
+    if count == "auto":
+        return {}
+    options: Dict[str, Any] = {"shard_count": int(count)}
+    ids = os.environ.get('SHARD_IDS')
+    if ids:
+        options["shard_ids"] = parse_shard_ids(ids)
+    return options
+
+
+def process_key() -> Optional[str]:
+    """Name of the range of shards of this process, None when it runs them all"""
+    options = shard_options()
+    if not options or "shard_ids" not in options:
+        return None
+    parts = [part.strip() for part in os.environ['SHARD_IDS'].split(",") if part.strip()]
+    return "shards-{}".format("_".join(parts))
+
+
+def per_process(path: str) -> str:
+    """`path` of this process' own copy of a file, see `process_key`"""
+    key = process_key()
+    if key is None:
+        return path
+    base, ext = os.path.splitext(path)
+    return "{}.{}{}".format(base, key, ext)
+
+
+def server_port() -> int:
+    """Port of the server of this process, offset by its first shard"""
+    port = int(os.environ.get('SERVER_PORT', 63083))
+    options = shard_options()
+    if options and options.get("shard_ids"):
+        port += min(options["shard_ids"])
+    return port
+
+
+def receives_dms() -> bool:
+    """Whether this process runs shard 0, the one discord sends DMs to"""
+    options = shard_options()
+    return not options or 0 in options.get("shard_ids", [0])
+
+
+Message = Union[PlayerJoined, PlayerLeft]
+
+
+class ShardRouter:
+    """
+    Stand-in for the bot's backend queue: messages are put in the queue
+    of the shard of their guild, each queue being read by its own
+    `consume` task. The events of a guild stay in order while a busy
+    shard doesn't hold up the others.
+    """
+
+    def __init__(self, shard_count: Callable[[], Optional[int]],
+                 consume: Callable[[asyncio.Queue], Awaitable[None]]):
+        self.logger = helper.default_logger("ShardRouter", logging.INFO)
+        self._shard_count = shard_count
+        self._consume = consume
+        self.queues: Dict[int, asyncio.Queue] = {}
+        self._consumers: Dict[int, asyncio.Future] = {}
+
+    def queue(self, shard: int) -> asyncio.Queue:
+        queue = self.queues.get(shard)
+        if queue is None:
+            self.logger.info("Starting backend queue of shard %d", shard)
+            queue = make_queue()
+            self.queues[shard] = queue
+            self._consumers[shard] = asyncio.ensure_future(self._consume(queue))
+        return queue
+
+    async def put(self, message: Message):
+        shard = shard_of(message.server_id, self._shard_count() or 1)
+        await self.queue(shard).put(message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"shardCount": self._shard_count(),
+                "backlog": {shard: queue.qsize()
+                            for shard, queue in sorted(self.queues.items())}}
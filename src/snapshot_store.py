@@ -0,0 +1,248 @@
+"""
+Storage backends for player stat snapshots
+
+Two backends are available, selected with SNAPSHOT_BACKEND:
+- "files": one JSON file per snapshot in players/<btag>/ (legacy layout)
+- "sqlite": a single indexed SQLite file, writes batched in transactions
+
+Existing snapshot directories can be imported in the SQLite store with:
+    python src/snapshot_store.py migrate <players dir> <database file>
+"""
+
+import os
+import sys
+import json
+import asyncio
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Iterator, List, Optional, Tuple
+
+import helper
+from ratelimit import backoff
+
+
+Snapshot = Tuple[datetime, Any]
+
+# Importing the same snapshot twice replaces it instead of duplicating it
+_insert = "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)"
+
+
+class SnapshotStore(ABC):
+    """Keep the history of stats fetched for each btag"""
+
+    @abstractmethod
+    async def latest(self, btag: str) -> Optional[Snapshot]:
+        """Most recent snapshot of a btag or None if there is none"""
+
+    @abstractmethod
+    async def save(self, btag: str, data: Any,
+                   taken_at: Optional[datetime] = None):
+        """Add a snapshot to the history of a btag"""
+
+    async def close(self):
+        """Flush pending writes and release resources"""
+
+
+class FileSnapshotStore(SnapshotStore):
+    """One JSON file per snapshot, one directory per btag"""
+
+    _timeformat = "%d-%m-%Y_%H%M%S"
+
+    def __init__(self, root: str):
+        self.root = root
+
+    @classmethod
+    def _parse_name(cls, fname: str) -> Optional[datetime]:
+        try:
+            return datetime.strptime(fname[:-len(".json")], cls._timeformat)
+        except ValueError:
+            return None
+
+    def history(self, btag: str) -> Iterator[Tuple[datetime, str]]:
+        """(date, path) of every snapshot of a btag, in no particular order"""
+        playerdir = os.path.join(self.root, btag)
+        if not os.path.isdir(playerdir):
+            return
+        for fname in os.listdir(playerdir):
+            taken_at = self._parse_name(fname)
+            if taken_at is not None:
+                yield taken_at, os.path.join(playerdir, fname)
+
+    def _latest(self, btag: str) -> Optional[Snapshot]:
+        # File names sort by day first, the date has to be parsed
+        newest = max(self.history(btag), default=None)
+        if newest is None:
+            return None
+        with open(newest[1], 'r') as file:
+            return newest[0], json.load(file)
+
+    def _save(self, btag: str, data: Any, taken_at: datetime):
+        playerdir = os.path.join(self.root, btag)
+        os.makedirs(playerdir, exist_ok=True)
+        fname = taken_at.strftime(self._timeformat) + ".json"
+        with open(os.path.join(playerdir, fname), 'w') as file:
+            file.write(json.dumps(data))
+
+    async def latest(self, btag: str) -> Optional[Snapshot]:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._latest, btag)
+
+    async def save(self, btag: str, data: Any,
+                   taken_at: Optional[datetime] = None):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._save, btag, data,
+                                   taken_at or datetime.now())
+
+
+class SQLiteSnapshotStore(SnapshotStore):
+    """
+    Snapshots in a single SQLite file, indexed on (btag, date).
+    Writes are buffered and flushed together in one transaction,
+    either after `flush_delay` seconds or once `batch_size` are pending.
+    """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            btag TEXT NOT NULL,
+            taken_at REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS snapshots_latest
+            ON snapshots (btag, taken_at DESC);
+    """
+
+    def __init__(self, path: str, batch_size: int = 100,
+                 flush_delay: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_delay = flush_delay
+        self.logger = helper.default_logger("SnapshotStore", logging.INFO)
+        # sqlite connections are used from a single dedicated thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: List[Tuple[str, float, str]] = []
+        self._writing: List[Tuple[str, float, str]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Flushes failed in a row
+        self._failures = 0
+
+    @staticmethod
+    def connect(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SQLiteSnapshotStore._schema)
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = self.connect(self.path)
+        return self._conn
+
+    def _latest(self, btag: str) -> Optional[Tuple[float, str]]:
+        return self._connection().execute(
+            "SELECT taken_at, data FROM snapshots WHERE btag = ? "
+            "ORDER BY taken_at DESC LIMIT 1", (btag,)).fetchone()
+
+    def _write(self, rows: List[Tuple[str, float, str]]):
+        conn = self._connection()
+        with conn:
+            conn.executemany(_insert, rows)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def latest(self, btag: str) -> Optional[Snapshot]:
+        # Snapshots not written yet are the most recent ones
+        for row_btag, taken_at, data in reversed(self._writing + self._pending):
+            if row_btag == btag:
+                return datetime.fromtimestamp(taken_at), json.loads(data)
+        row = await self._run(self._latest, btag)
+        if row is None:
+            return None
+        return datetime.fromtimestamp(row[0]), json.loads(row[1])
+
+    async def save(self, btag: str, data: Any,
+                   taken_at: Optional[datetime] = None):
+        taken_at = taken_at or datetime.now()
+        self._pending.append((btag, taken_at.timestamp(), json.dumps(data)))
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        elif self._flush_handle is None:
+            self._schedule_flush(self.flush_delay)
+
+    def _schedule_flush(self, delay: float):
+        loop = asyncio.get_event_loop()
+        self._flush_handle = loop.call_later(
+            delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        self._writing += rows
+        try:
+            await self._run(self._write, rows)
+        except sqlite3.Error:
+            self.logger.exception("Could not write %d snapshots", len(rows))
+            self._pending = rows + self._pending
+            # Don't wait for the next save to try again
+            self._failures += 1
+            self._schedule_flush(backoff(self._failures, self.flush_delay))
+        else:
+            self._failures = 0
+        finally:
+            del self._writing[:len(rows)]
+
+    async def close(self):
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+
+def make_store(root: str) -> SnapshotStore:
+    """Snapshot store configured by SNAPSHOT_BACKEND and SNAPSHOT_DB"""
+    backend = os.environ.get('SNAPSHOT_BACKEND', 'files')
+    if backend == 'sqlite':
+        path = os.environ.get('SNAPSHOT_DB', root + ".sqlite3")
+        return SQLiteSnapshotStore(path)
+    if backend == 'files':
+        return FileSnapshotStore(root)
+    raise ValueError("Unknown snapshot backend {}".format(backend))
+
+
+def migrate(root: str, path: str, batch_size: int = 1000) -> int:
+    """Import every snapshot file under `root` in the SQLite database `path`"""
+    files = FileSnapshotStore(root)
+    conn = SQLiteSnapshotStore.connect(path)
+    count = 0
+    rows: List[Tuple[str, float, str]] = []
+    for btag in sorted(os.listdir(root)):
+        for taken_at, fname in sorted(files.history(btag)):
+            with open(fname, 'r') as file:
+                rows.append((btag, taken_at.timestamp(), file.read()))
+            if len(rows) >= batch_size:
+                with conn:
+                    conn.executemany(_insert, rows)
+                count += len(rows)
+                rows = []
+    with conn:
+        conn.executemany(_insert, rows)
+    count += len(rows)
+    conn.close()
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "migrate":
+        print("usage: {} migrate <players dir> <database file>".format(sys.argv[0]))
+        sys.exit(1)
+    print("Imported {} snapshots".format(migrate(sys.argv[2], sys.argv[3])))
@@ -1,10 +1,87 @@
-from typing import Union
+import time
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, Union
 from bot import MyClient
 import discord
 import pug_vc
 from messages import PlayerLeft
 
 
+class _PendingMove():
+    def __init__(self, mem: discord.Member,
+                 before: Optional[discord.VoiceChannel],
+                 after: Optional[discord.VoiceChannel]):
+        self.member = mem
+        self.before = before
+        self.after = after
+        self.first_seen = time.monotonic()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class VoiceStateCoalescer():
+    """Hold the voice state changes of a member for `window` seconds
+    and only report the net move (first channel -> last channel).
+    A member flicking lobby -> team -> lobby, or reconnecting, is one
+    no-op instead of several moves. A member moving for longer than
+    `max_delay` is reported anyway."""
+
+    def __init__(self, window: float,
+                 report: Callable[[discord.Member,
+                                   Optional[discord.VoiceChannel],
+                                   Optional[discord.VoiceChannel]], Awaitable],
+                 max_delay: Optional[float] = None):
+        self.window = window
+        self.max_delay = max_delay if max_delay is not None else 5 * window
+        self._report = report
+        self._pending: Dict[int, _PendingMove] = {}
+        self.received = 0
+        self.reported = 0
+        self.cancelled = 0
+
+    async def push(self, mem: discord.Member,
+                   before: Optional[discord.VoiceChannel],
+                   after: Optional[discord.VoiceChannel]):
+        self.received += 1
+        if self.window <= 0:
+            self.reported += 1
+            await self._report(mem, before, after)
+            return
+        pending = self._pending.get(mem.id)
+        if pending is None:
+            pending = _PendingMove(mem, before, after)
+            self._pending[mem.id] = pending
+        else:
+            assert pending.timer
+            pending.timer.cancel()
+            pending.member = mem
+            pending.after = after
+        delay = min(self.window,
+                    max(0.0, pending.first_seen + self.max_delay - time.monotonic()))
+        pending.timer = asyncio.get_event_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self._flush(mem.id)))
+
+    async def _flush(self, mid: int):
+        pending = self._pending.pop(mid, None)
+        if pending is None:
+            return
+        before_id = pending.before.id if pending.before else None
+        after_id = pending.after.id if pending.after else None
+        if before_id == after_id:
+            self.cancelled += 1
+            return
+        self.reported += 1
+        await self._report(pending.member, pending.before, pending.after)
+
+    def is_pending(self, mid: int) -> bool:
+        return mid in self._pending
+
+    def stats(self):
+        return {"pending": len(self._pending),
+                "received": self.received,
+                "reported": self.reported,
+                "cancelled": self.cancelled}
+
+
 class VoiceChannelManager():
     """Class handling what happens when someone join/leave voice a voice channel"""
     def __init__(self, client: MyClient):
@@ -34,6 +111,21 @@ class VoiceChannelManager():
                                  after.voice_chan.name)
         await self._client._handle_joining_lobby(mem, before, after)
 
+    async def on_joining_team_vc(self, mem: discord.Member,
+                                 before: pug_vc.Other,
+                                 after: pug_vc.Team):
+        """Called when connecting to a team VC (when not connected before),
+        handled as joining the lobby of that team"""
+        channel_id = self._client.vc_index.lobby_channel(after.voice_chan.id)
+        if channel_id is None:
+            return
+        channel = after.voice_chan.guild.get_channel(channel_id)
+        if not isinstance(channel, discord.VoiceChannel):
+            self._client.logger.warning("Lobby VC of team %s not found",
+                                        after.voice_chan.name)
+            return
+        await self.on_joining_lobby(mem, before, pug_vc.Lobby(channel, after.lobby_name))
+
     async def on_changing_lobby(self, mem: discord.Member,
                                 before: Union[pug_vc.Lobby, pug_vc.Team],
                                 after: Union[pug_vc.Lobby, pug_vc.Team]):
@@ -52,12 +144,10 @@ class VoiceChannelManager():
         if isinstance(after, pug_vc.Lobby):
             await self._client.players.register(mem.id, after.voice_chan)
         else:
-            channel_id = self._client.invert_lobby_lookup[after.voice_chan.guild.id][after.voice_chan.id]
-            channel = None
-            for chan in after.voice_chan.guild.voice_channels:
-                if chan.id == channel_id:
-                    channel = chan
-            assert(channel)
+            channel_id = self._client.vc_index.lobby_channel(after.voice_chan.id)
+            assert(channel_id)
+            channel = after.voice_chan.guild.get_channel(channel_id)
+            assert(isinstance(channel, discord.VoiceChannel))
             await self._client.players.register(mem.id, channel)
 
     async def on_back_lobby(self, mem: discord.Member,